@@ -14,7 +14,8 @@ setup(
     setup_requires   = [],
     install_requires = ['Cython',
                         'scipy==1.4.1',
-                        'torch>=1.5.0',
+                        'torch>=2.3.0', # Native AMP; DDP gradient_as_bucket_view; cuda.mem_get_info; Module.compile;
+                                        # init_process_group device_id
                         #'keras>=2.3.1',
                         #'tensorflow>=2.2.0',
                         'tqdm>=4.46.0',
@@ -24,10 +25,10 @@ setup(
                         'pandas>=1.0.4',
                         'matplotlib>=3.2.1',
                         'portpicker>=1.3.1',
-                        'transformers>=2.11.0',
+                        'transformers>=4.20.0', # low_cpu_mem_usage; gradient_checkpointing_enable
+                        'accelerate>=0.20.0',   # Required by transformers for low_cpu_mem_usage
                         'seaborn>=0.10.1',
-                        'GPUtil>=1.4.0',
-                        'pytorch-extension>=0.1' # Nvidia APEX module for mixed floating point
+                        'GPUtil>=1.4.0'
                         ],
 
                         #pytorch-nlp
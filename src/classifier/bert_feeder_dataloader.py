@@ -3,11 +3,19 @@ Created on Jun 12, 2020
 
 @author: paepcke
 '''
-from contextlib import contextmanager
+from functools import partial
+import math
+import os
+import random
 
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 
+import numpy as np
+from logging_service import LoggingService
+
 
 class SqliteDataLoader(DataLoader):
     '''
@@ -15,39 +23,34 @@ class SqliteDataLoader(DataLoader):
     BertFeederDataset (see bert_feeder_dataset.py).
     This class simply wraps such a dataset. See
     header comment in that file for lots more
-    information, such as dataset splitting, 
-    switching between the splits, interacting
-    either as a stream or a dict. 
+    information, such as dataset splitting, and
+    interacting either as a stream or a dict. 
     
     Instances can be used like any other Pytorch
-    dataloader.
-    
-    This class adds a dataset split context manager.
-    It allows callers to interact temporarily with 
-    a particular split: test/validate/train, and
-    then return to the current split. Example:
+    dataloader. In particular, len() is the number of
+    batches, not of samples.
     
-      with set_split_id('validate'):
-          avg_val_accuracy = total_eval_accuracy / len(dataloader)
+    Note: do not override __next__() here, and have any 
+    __iter__() override return the result of DataLoader.__iter__(),
+    which is Pytorch's own iterator. For num_workers > 0 that
+    iterator owns the worker processes, their queues, and the
+    prefetching. The dataset's own __iter__()/__next__() stream
+    interface is independent of this loader.
     
+    Each instance serves exactly one dataset split, 
+    whose id is available via split_id(). Use make_loaders()
+    to obtain one loader for each split. Other attributes, 
+    such as reset(), are looked up on the dataset.
     '''
     #------------------------------------
     # Constructor 
     #-------------------
     
     def __init__(self, dataset, *args, **kwargs):
+        kwargs.setdefault('collate_fn', collate_presliced)
         super().__init__(dataset, *args, **kwargs)
         self.my_split = dataset.split_id()
 
-    #------------------------------------
-    # split 
-    #-------------------
-
-    # No longer allowed. Instance is now initialized
-    # with a frozen sub-collection.
-    #def split_dataset(self, *args, **kwargs):
-    #    self.dataset.split_dataset(*args, sample_ids_or_df=None, **kwargs)
-
     #------------------------------------
     # curr_split 
     #-------------------
@@ -58,26 +61,26 @@ class SqliteDataLoader(DataLoader):
         'validate', or 'test'
         '''
         return self.my_split
-        #return self.dataset.curr_split_id()
 
     #------------------------------------
-    # reset_split
+    # __getattr__
     #-------------------
 
-    def reset(self):
+    def __getattr__(self, name):
         '''
-        Sets the dataset's queue to the
-        start.
+        Pass attributes that the loader does not have
+        on to its dataset. Examples are reset(), which 
+        sets the dataset's queue to the start, and the
+        preloaded arrays, such as labels. Only called 
+        when normal lookup fails, so the loader's own
+        attributes are not slowed down.
         '''
-        self.dataset.reset()
-
-    #------------------------------------
-    # __len__ 
-    #-------------------
+        # Guard against recursion while 'dataset' itself
+        # is not yet set, e.g. during unpickling:
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
 
-    def __len__(self):
-        return len(self.dataset)
-    
     #------------------------------------
     # __getitem__
     #-------------------
@@ -88,26 +91,238 @@ class SqliteDataLoader(DataLoader):
 # -------------------- Multiprocessing Dataloader -----------
 
 class MultiprocessingDataloader(SqliteDataLoader):
+    '''
+    Dataloader for use with DistributedDataParallel. Each
+    process draws only its share of the samples via a 
+    DistributedSampler. 
+    
+    Batches are collated into pinned (page-locked) host 
+    memory when CUDA is available. Callers should move them to the GPU 
+    with non_blocking=True, so that the host-to-device copy
+    overlaps with the ongoing forward/backward computation.
+    The module level to_device() does that for a whole batch:
+    
+        for batch in dataloader:
+            batch = to_device(batch, cuda_dev)
+            
+    With num_workers > 0, batch assembly and pinning run in
+    separate worker processes, rather than in the training
+    loop's thread. By default the CPUs of the machine are 
+    divided among the world_size processes. Workers are kept
+    alive across epochs (persistent_workers), so they are
+    only forked once. Each worker loads prefetch_factor batches
+    ahead, so slow batches do not stall the training loop. 
+    Both options only apply when workers are used.
+    
+    Pinning itself is left to the DataLoader's pin-memory
+    thread in the main process, rather than being done in the 
+    workers: forked workers may not initialize CUDA, and 
+    pinned pages would not survive the transfer from a worker
+    to the main process anyway. Batches are dicts of tensors,
+    which that thread pins without any help from the dataset.
+    
+    With shuffle=True, the sampler permutes the samples
+    differently in each epoch, using the epoch number as part
+    of the random seed. Callers must therefore call set_epoch()
+    before each pass through the data. Otherwise all epochs
+    would see the same order. If a pass is started without 
+    a set_epoch() since the previous pass, the epoch is advanced
+    automatically, and a warning is logged.
+    
+    For training across several machines, pass num_nodes > 1,
+    together with this process' local_rank. A NodeLocalDistributedSampler
+    then keeps each node's share of the samples fixed across
+    epochs, and only shuffles within the node. In that case
+    node_rank must be the rank of the machine, not of the process.
+    
+    With bucket_by_length=True, a BucketBatchSampler groups
+    this process' samples into batches of similar length, so
+    that little padding remains after the dataset trims each 
+    batch. Passing width_multiple rounds those trimmed widths
+    up to a multiple of that many columns. Compiled models 
+    that record CUDA graphs then only record one graph per
+    rounded width, rather than one per distinct width.
+    
+    On machines with several CPU sockets, pass the gpu_id
+    of the GPU this process trains on. Workers are then 
+    bound to the CPUs of the NUMA node to which that GPU 
+    is attached, so batches are assembled in memory that 
+    is local to the GPU. 
+    
+    When training on more than one process, drop_last 
+    defaults to True: samplers drop the tail samples that 
+    do not divide evenly among the processes, instead of 
+    padding with duplicates, and the final short batch is 
+    dropped. All processes thus run the same number of 
+    full-sized steps. Evaluation loaders should pass 
+    drop_last=False, so that all samples are seen.
+    '''
     
     #------------------------------------
     # Constructor 
     #-------------------
 
-    def __init__(self, dataset, world_size, node_rank, **kwargs):
+    def __init__(self, 
+                 dataset, 
+                 world_size, 
+                 node_rank,
+                 num_workers=None,
+                 prefetch_factor=None,
+                 persistent_workers=True,
+                 pin_memory=None,
+                 shuffle=True,
+                 num_nodes=1,
+                 local_rank=0,
+                 bucket_by_length=False,
+                 num_buckets=50,
+                 gpu_id=None,
+                 drop_last=None,
+                 width_multiple=None,
+                 **kwargs):
+        '''
+        @param dataset: the (frozen) dataset split to serve
+        @type dataset: FrozenDataset
+        @param world_size: number of processes across all nodes
+        @type world_size: int
+        @param node_rank: rank of this process. If num_nodes > 1:
+            rank of this machine
+        @type node_rank: int
+        @param num_workers: number of worker processes that 
+            assemble batches. 0 means: in the main process.
+            Default: number of CPUs divided by the number of 
+            processes on this node: LOCAL_WORLD_SIZE from the 
+            environment, else world_size / num_nodes
+        @type num_workers: {None|int}
+        @param prefetch_factor: number of batches each worker
+            loads ahead of time. None leaves Pytorch's default of 2.
+            Larger values rarely help: once tokenized batches are
+            ready before the GPU asks for them, more lookahead
+            only costs memory. Requires num_workers > 0
+        @type prefetch_factor: {None|int}
+        @param persistent_workers: whether to keep workers alive
+            between epochs
+        @type persistent_workers: bool
+        @param pin_memory: whether to collate batches into pinned memory.
+            Default: only if CUDA is available
+        @type pin_memory: {None|bool}
+        @param shuffle: whether the sampler permutes the samples
+            anew in each epoch
+        @type shuffle: bool
+        @param num_nodes: number of machines. If more than 1,
+            samples are partitioned by node, and only shuffled
+            within each node
+        @type num_nodes: int
+        @param local_rank: rank of this process within its node;
+            only used if num_nodes > 1
+        @type local_rank: int
+        @param bucket_by_length: whether to batch samples of
+            similar length together. Requires a dataset with
+            a lengths array, such as FrozenDataset
+        @type bucket_by_length: bool
+        @param num_buckets: number of length buckets; only
+            used if bucket_by_length is True
+        @type num_buckets: int
+        @param gpu_id: GPU to whose NUMA node workers are bound.
+            None, or no GPU topology available: workers are 
+            not bound
+        @type gpu_id: {None|int}
+        @param drop_last: whether to drop samples and the short
+            final batch rather than pad. Default: True if 
+            world_size > 1
+        @type drop_last: {None|bool}
+        @param width_multiple: round batch widths up to a multiple
+            of this many columns. Sets the dataset's width_multiple.
+            None: leave the dataset's setting
+        @type width_multiple: {None|int}
+        @raise ValueError: if prefetch_factor is given, but no
+            workers are used
+        '''
         
         self.dataset  = dataset
+        if width_multiple is not None:
+            dataset.width_multiple = width_multiple
         
-        self.sampler = DistributedSampler(
+        if drop_last is None:
+            drop_last = world_size > 1
+        
+        if num_nodes > 1:
+            self.sampler = NodeLocalDistributedSampler(
                 dataset,
-                num_replicas=world_size,
-                rank=node_rank
+                num_nodes=num_nodes,
+                node_rank=node_rank,
+                procs_per_node=world_size // num_nodes,
+                local_rank=local_rank,
+                shuffle=shuffle,
+                drop_last=drop_last
                 )
+        else:
+            self.sampler = DistributedSampler(
+                    dataset,
+                    num_replicas=world_size,
+                    rank=node_rank,
+                    shuffle=shuffle,
+                    drop_last=drop_last
+                    )
+        # Whichever sampler set_epoch() must reach:
+        self.epoch_sampler = self.sampler
+        
+        if bucket_by_length:
+            # The DataLoader accepts neither sampler nor
+            # batch_size nor drop_last together with a 
+            # batch_sampler, so the bucketing sampler drops
+            # the short final batch itself:
+            self.epoch_sampler = BucketBatchSampler(self.sampler,
+                                                    kwargs.pop('batch_size', 1),
+                                                    dataset.lengths,
+                                                    num_buckets=num_buckets,
+                                                    shuffle=shuffle,
+                                                    drop_last=drop_last)
+            kwargs['batch_sampler'] = self.epoch_sampler
+        else:
+            kwargs['sampler'] = self.sampler
+            kwargs['drop_last'] = drop_last
+
+        self.shuffle_each_epoch = shuffle
+        # Epoch of the current pass, and whether
+        # set_epoch() was called since the previous
+        # pass. The first pass is epoch 0:
+        self.epoch = 0
+        self.epoch_is_fresh = True
+
+        if num_workers is None:
+            # Only the processes on this machine share its CPUs:
+            procs_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', 
+                                                world_size // num_nodes))
+            num_workers = (os.cpu_count() or 1) // max(1, procs_per_node)
+
+        # Pinning without CUDA only costs time:
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+
+        if prefetch_factor is not None and num_workers == 0:
+            raise ValueError("prefetch_factor requires num_workers > 0; only workers prefetch batches.")
+
+        # The DataLoader refuses persistent_workers when
+        # no workers are used:
+        if num_workers > 0:
+            if prefetch_factor is not None:
+                kwargs['prefetch_factor'] = prefetch_factor
+            kwargs['persistent_workers'] = persistent_workers
+            # Look up the GPU's CPUs once here, rather than
+            # in each worker:
+            cpus = gpu_cpu_affinity(gpu_id) if gpu_id is not None else None
+            if cpus:
+                kwargs.setdefault('worker_init_fn',
+                                  partial(numa_pin_worker, 
+                                          cpus=cpus, 
+                                          num_workers=num_workers))
+            else:
+                kwargs.setdefault('worker_init_fn', seed_worker)
 
         super().__init__(dataset,
                          shuffle=False,
-                         num_workers=0,
-                         pin_memory=True,
-                         sampler=self.sampler,
+                         num_workers=num_workers,
+                         pin_memory=pin_memory,
                          **kwargs)
 
     #------------------------------------
@@ -115,44 +330,666 @@ class MultiprocessingDataloader(SqliteDataLoader):
     #-------------------
 
     def set_epoch(self, epoch):
+        self.epoch_sampler.set_epoch(epoch)
+        self.epoch = epoch
+        self.epoch_is_fresh = True
+
+    #------------------------------------
+    # __iter__ 
+    #-------------------
+
+    def __iter__(self):
+        '''
+        Advance the epoch if the caller did not do so
+        via set_epoch() since the previous pass. Then 
+        return Pytorch's iterator.
+        
+        This runs once per pass, not per batch. It cannot
+        live in an override of _get_iterator(): with 
+        persistent workers, DataLoader.__iter__() builds 
+        the iterator only for the first pass, and merely
+        resets it for later ones.
+        '''
+        if self.shuffle_each_epoch and not self.epoch_is_fresh:
+            LoggingService().warn(f"set_epoch() not called before pass over data; advancing to epoch {self.epoch + 1}")
+            self.set_epoch(self.epoch + 1)
+        self.epoch_is_fresh = False
+        return super().__iter__()
+
+# -------------------- Node-Local Distributed Sampler -----------
+
+class NodeLocalDistributedSampler(Sampler):
+    '''
+    Distributed sampler for multi-machine training that
+    keeps samples on the same node for all epochs. 
+    
+    The pytorch DistributedSampler shuffles globally, so a
+    sample drawn on node A in one epoch may be drawn on node
+    B in the next. Any per-node cache of samples (tokenized 
+    inputs, page cache of the Sqlite db) then misses.
+    
+    This sampler partitions the sample indices among the nodes
+    once, by node_rank. In each epoch only the node's own 
+    indices are permuted, using seed + epoch as random seed.
+    The permutation is then dealt out to the node's processes
+    by local_rank.
+    
+    Assumes the same number of processes on each node. Every
+    process draws the same number of samples per epoch; short
+    node partitions are padded by repeating some of their 
+    samples. With drop_last=True, long partitions are instead
+    truncated.
+    '''
+
+    #------------------------------------
+    # Constructor 
+    #-------------------
+
+    def __init__(self,
+                 dataset,
+                 num_nodes,
+                 node_rank,
+                 procs_per_node,
+                 local_rank,
+                 shuffle=True,
+                 seed=0,
+                 drop_last=False):
+        '''
+        @param dataset: the dataset to sample from
+        @type dataset: Dataset
+        @param num_nodes: number of machines
+        @type num_nodes: int
+        @param node_rank: rank of this machine
+        @type node_rank: int
+        @param procs_per_node: number of processes on each machine
+        @type procs_per_node: int
+        @param local_rank: rank of this process within its machine
+        @type local_rank: int
+        @param shuffle: whether to permute the node's samples each epoch
+        @type shuffle: bool
+        @param seed: random seed; must be the same on all nodes
+        @type seed: int
+        @param drop_last: whether to drop samples, rather than 
+            pad, so that all processes draw the same number
+        @type drop_last: bool
+        '''
+        if node_rank >= num_nodes or local_rank >= procs_per_node:
+            raise ValueError(f"Bad rank: node {node_rank} of {num_nodes}, local {local_rank} of {procs_per_node}")
+
+        self.procs_per_node = procs_per_node
+        self.local_rank = local_rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        
+        # Fixed partition of sample indices for this node:
+        self.node_indices = list(range(node_rank, len(dataset), num_nodes))
+        
+        # Number of samples each process draws:
+        if drop_last:
+            self.num_samples = len(dataset) // (num_nodes * procs_per_node)
+        else:
+            self.num_samples = math.ceil(len(dataset) / (num_nodes * procs_per_node))
+
+    #------------------------------------
+    # __iter__ 
+    #-------------------
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.node_indices), generator=generator).tolist()
+            indices = [self.node_indices[i] for i in order]
+        else:
+            indices = list(self.node_indices)
+        
+        if len(indices) == 0:
+            return iter(indices)
+
+        # Pad by wrapping around, so that all processes
+        # on all nodes draw the same number of samples:
+        total_size = self.num_samples * self.procs_per_node
+        while len(indices) < total_size:
+            indices += indices[:total_size - len(indices)]
+        indices = indices[:total_size]
+        
+        return iter(indices[self.local_rank:total_size:self.procs_per_node])
+
+    #------------------------------------
+    # __len__ 
+    #-------------------
+
+    def __len__(self):
+        return self.num_samples
+
+    #------------------------------------
+    # set_epoch 
+    #-------------------
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+# -------------------- Bucket Batch Sampler -----------
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batch sampler that puts samples of similar length
+    into the same batch. 
+    
+    BERT pads every sample of a batch to the longest one.
+    When lengths vary, batches of randomly drawn samples
+    are therefore mostly padding. This sampler takes the
+    indices that the wrapped sampler yields for this process,
+    sorts them by length, and divides them into num_buckets
+    buckets of (nearly) equal size. Batches are cut from within
+    each bucket, and the order of all batches is shuffled.
+    Bucket sizes are multiples of batch_size, so only the
+    last bucket can end in a short batch. With drop_last,
+    that batch is dropped.
+    
+    Wrapping a DistributedSampler or NodeLocalDistributedSampler
+    keeps their partitioning of samples among processes.
+    Since those samplers hand all processes the same number
+    of samples, all processes get the same number of batches.
+    '''
+
+    #------------------------------------
+    # Constructor 
+    #-------------------
+
+    def __init__(self, 
+                 sampler, 
+                 batch_size, 
+                 lengths, 
+                 num_buckets=50, 
+                 shuffle=True,
+                 drop_last=False,
+                 seed=0):
+        '''
+        @param sampler: sampler that yields this process' sample indices
+        @type sampler: Sampler
+        @param batch_size: maximum number of samples per batch
+        @type batch_size: int
+        @param lengths: number of non-padding tokens of each 
+            sample in the dataset
+        @type lengths: np.array
+        @param num_buckets: number of length buckets
+        @type num_buckets: int
+        @param shuffle: whether to shuffle within buckets, and
+            the order of batches; differently in each epoch
+        @type shuffle: bool
+        @param drop_last: whether to drop the short final batch
+        @type drop_last: bool
+        @param seed: random seed; must be the same in all processes
+        @type seed: int
+        '''
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.lengths = np.asarray(lengths)
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    #------------------------------------
+    # __iter__ 
+    #-------------------
+
+    def __iter__(self):
+        indices = np.array(list(self.sampler), dtype=np.int64)
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            # Random order among samples of equal length:
+            indices = rng.permutation(indices)
+        indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+
+        batches = []
+        for bucket in self.buckets(indices):
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            batches.extend(bucket[start:start + self.batch_size].tolist()
+                           for start in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # Processes that disagree on the number of batches
+        # would hang in the gradient AllReduce:
+        assert len(batches) == len(self), \
+            f"BucketBatchSampler made {len(batches)} batches, rather than {len(self)}"
+        return iter(batches)
+
+    #------------------------------------
+    # __len__ 
+    #-------------------
+
+    def __len__(self):
+        return self.num_batches(len(self.sampler))
+
+    #------------------------------------
+    # num_batches 
+    #-------------------
+
+    def num_batches(self, num_samples):
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return math.ceil(num_samples / self.batch_size)
+
+    #------------------------------------
+    # buckets 
+    #-------------------
+
+    def buckets(self, indices):
+        '''
+        Divide indices into at most num_buckets non-empty 
+        consecutive chunks of (nearly) equal size. Chunks 
+        hold whole batches; only the last may hold a short 
+        one. With drop_last, the indices of that short batch
+        are left out.
+        '''
+        num_batches = self.num_batches(len(indices))
+        if num_batches == 0:
+            return []
+        num_buckets = min(self.num_buckets, num_batches)
+        return [indices[batch_nums[0] * self.batch_size : (batch_nums[-1] + 1) * self.batch_size]
+                for batch_nums in np.array_split(np.arange(num_batches), num_buckets)]
+
+    #------------------------------------
+    # set_epoch 
+    #-------------------
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
         self.sampler.set_epoch(epoch)
 
-# ------------------------ set_split_id Context Manager
+# -------------------- CUDA Prefetcher -----------
+
+class CudaPrefetcher(object):
+    '''
+    Wraps a dataloader, and delivers its batches already
+    on a GPU. While the caller computes on one batch, the 
+    next batch is copied to the GPU on a separate CUDA 
+    stream, so the copy overlaps with the computation. The 
+    dataloader should deliver batches in pinned memory, 
+    which MultiprocessingDataloader does when CUDA is available.
+    
+        for batch in CudaPrefetcher(dataloader, cuda_dev):
+            model(batch['tok_ids'].long(), ...)
+            
+    Batches are dicts with one tensor per column, already 
+    in their narrowest dtypes. Packing the columns into a 
+    single tensor would save a few copy calls, but would 
+    widen every column to the widest dtype. Columns that 
+    are only needed on the host, such as the sample ids,
+    are left there rather than copied.
+    '''
+
+    #------------------------------------
+    # Constructor 
+    #-------------------
+
+    def __init__(self, dataloader, device, host_keys=('sample_id',)):
+        '''
+        @param dataloader: source of batches in host memory
+        @type dataloader: DataLoader
+        @param device: the GPU to deliver batches to
+        @type device: {int|torch.device}
+        @param host_keys: keys of dict batches whose values
+            are not copied to the GPU
+        @type host_keys: (str)
+        '''
+        self.dataloader = dataloader
+        self.device = device
+        self.host_keys = host_keys
+
+    #------------------------------------
+    # __len__ 
+    #-------------------
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    #------------------------------------
+    # __iter__ 
+    #-------------------
+
+    def __iter__(self):
+        copy_stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.dataloader)
+        next_batch = self.preload(batches, copy_stream)
+        while next_batch is not None:
+            # Wait for the batch's copy before computing on it:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_stream(copy_stream)
+            batch = next_batch
+            # Memory allocated on the copy stream must not be
+            # reused before the compute stream is done with it:
+            for tensor in batch.values():
+                if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                    tensor.record_stream(compute_stream)
+            next_batch = self.preload(batches, copy_stream)
+            yield batch
+
+    #------------------------------------
+    # preload 
+    #-------------------
+
+    def preload(self, batches, copy_stream):
+        '''
+        Start copying the next batch to the GPU
+        on copy_stream. Return None when the 
+        dataloader is exhausted.
+        '''
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(copy_stream):
+            return {key : val if key in self.host_keys else to_device(val, self.device)
+                    for key, val in batch.items()}
 
+# -------------------- DeviceResidentLoader -----------
 
+class DeviceResidentLoader(object):
+    '''
+    Wraps a dataloader over a FrozenDataset, and keeps 
+    the dataset's token ids, attention masks, and labels
+    on the GPU for the whole run. Batches are gathered
+    from those tensors directly, so no batch is assembled
+    by workers, pinned, or copied to the GPU. The arrays
+    are copied once, in the constructor. Worthwhile only 
+    if the split fits comfortably into GPU memory; see
+    nbytes().
+    
+    The wrapped dataloader still decides which samples
+    form each batch: its batch_sampler is iterated as
+    usual, so distributed sharding, shuffling, bucketing,
+    and dropping of the last batch all stay as configured.
+    Calls to set_epoch() are passed on to the dataloader. 
+    
+    Batches are dicts with the same keys and dtypes as 
+    those of FrozenDataset.__getitems__(), and are trimmed
+    to their last non-padding column, and rounded up to the
+    dataset's width_multiple, the same way. Sample 
+    ids stay in host memory.
+    
+        for batch in DeviceResidentLoader(dataloader, cuda_dev):
+            model(batch['tok_ids'].long(), ...)
+    '''
+
+    #------------------------------------
+    # Constructor 
+    #-------------------
+
+    def __init__(self, dataloader, device):
+        '''
+        @param dataloader: loader whose dataset is a FrozenDataset
+        @type dataloader: SqliteDataLoader
+        @param device: the GPU to keep the dataset on
+        @type device: {int|torch.device}
+        '''
+        self.dataloader = dataloader
+        self.device = device
+        
+        dataset = dataloader.dataset
+        self.sample_ids = torch.from_numpy(dataset.sample_id_arr)
+        self.tok_ids = torch.from_numpy(dataset.tok_ids).to(device)
+        self.attention_masks = torch.from_numpy(dataset.attention_masks).to(device)
+        self.labels = torch.from_numpy(dataset.labels).to(device)
+        
+        # Width up to each sample's last non-padding column, 
+        # computed once on the host. A batch's width is then 
+        # known without waiting for the GPU:
+        masks = dataset.attention_masks
+        if masks.shape[1] == 0:
+            # Empty split, stored as a (0,0) array:
+            self.widths = np.zeros(len(masks), dtype=np.int64)
+        else:
+            self.widths = np.where(masks.any(axis=1),
+                                   masks.shape[1] - np.argmax(masks[:, ::-1], axis=1),
+                                   0)
+        self.width_multiple = dataset.width_multiple
+
+    #------------------------------------
+    # nbytes
+    #-------------------
+
+    @staticmethod
+    def nbytes(dataset):
+        '''
+        Return the number of GPU memory bytes that a
+        DeviceResidentLoader would occupy for the dataset.
+        
+        @param dataset: the split to be kept on the GPU
+        @type dataset: FrozenDataset
+        @return: bytes of the token id, mask, and label arrays
+        @rtype: int
+        '''
+        return dataset.tok_ids.nbytes + \
+            dataset.attention_masks.nbytes + \
+            dataset.labels.nbytes
+
+    #------------------------------------
+    # set_epoch
+    #-------------------
+
+    def set_epoch(self, epoch):
+        self.dataloader.set_epoch(epoch)
+
+    #------------------------------------
+    # __len__ 
+    #-------------------
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    #------------------------------------
+    # __iter__ 
+    #-------------------
+
+    def __iter__(self):
+        for indices in self.dataloader.batch_sampler:
+            width = self.widths[indices].max(initial=0) or self.tok_ids.shape[1]
+            width = min(-(-width // self.width_multiple) * self.width_multiple, 
+                        self.tok_ids.shape[1])
+            gpu_indices = torch.as_tensor(indices).to(self.device, non_blocking=True)
+            yield {'sample_id'      : self.sample_ids[indices],
+                   'tok_ids'        : self.tok_ids[gpu_indices, :width],
+                   'attention_mask' : self.attention_masks[gpu_indices, :width],
+                   'label'          : self.labels[gpu_indices]
+                   }
+
+# ------------------------ Utilities -----------
 
 #------------------------------------
-# set_split_id [Context manager] 
+# make_loaders 
 #-------------------
+
+def make_loaders(dataset, batch_size, world_size=None, node_rank=None, **kwargs):
+    '''
+    Create one dataloader for each of the train, validate,
+    and test splits of a dataset on which split_dataset() 
+    has been called. Each loader works on its own 
+    FrozenDataset, so loaders never need to switch a shared
+    dataset between splits.
+    
+    If world_size is None, plain SqliteDataLoader instances
+    are created, else MultiprocessingDataloader instances.
+    In the latter case only the training loader reshuffles 
+    each epoch, and drops incomplete batches. 
+    
+    The validate and test loaders run once per epoch, while
+    the training loader's persistent workers stay alive. 
+    Unless kwargs say otherwise, they therefore get half as 
+    many workers as the training loader, started anew for
+    each pass.
     
-@contextmanager
-def set_split_id(dataloader, tmp_split_id):
+    @param dataset: a dataset that has been split
+    @type dataset: SqliteDataset
+    @param batch_size: number of samples per batch
+    @type batch_size: int
+    @param world_size: number of processes across all nodes, 
+        or None if not distributed
+    @type world_size: {None|int}
+    @param node_rank: rank of this process; only used if 
+        world_size is provided. If kwargs holds num_nodes > 1:
+        rank of this machine, with local_rank in kwargs (see
+        MultiprocessingDataloader)
+    @type node_rank: {None|int}
+    @param kwargs: passed on to each loader's constructor
+    @return: dict mapping 'train', 'validate', and 'test' to loaders
+    @rtype: {str : SqliteDataLoader}
     '''
-    Allows temporary setting of split_id like this:
+    loaders = {}
+    for split_id in ('train', 'validate', 'test'):
+        split = dataset.get_datasplit(split_id)
+        if world_size is None:
+            loaders[split_id] = SqliteDataLoader(split,
+                                                 batch_size=batch_size,
+                                                 **kwargs)
+        else:
+            # Evaluation must see every sample:
+            is_train = split_id == 'train'
+            split_kwargs = dict(kwargs)
+            if not is_train:
+                split_kwargs.setdefault('num_workers', loaders['train'].num_workers // 2)
+                split_kwargs.setdefault('persistent_workers', False)
+            loaders[split_id] = MultiprocessingDataloader(split,
+                                                          world_size,
+                                                          node_rank,
+                                                          batch_size=batch_size,
+                                                          shuffle=is_train,
+                                                          drop_last=None if is_train else False,
+                                                          **split_kwargs)
+    return loaders
+
+#------------------------------------
+# numa_pin_worker 
+#-------------------
+
+def numa_pin_worker(worker_id, cpus, num_workers):
+    '''
+    Worker init function that binds the worker to 
+    the given CPUs, and divides those CPUs' threads 
+    among the loader's workers. Seeds RNGs like
+    seed_worker(). Use with functools.partial to 
+    fill in cpus and num_workers. 
     
-      with set_split_id(dataloader, 'validate'):
-          dataloader.reset_split()
-          
-    or: get the validate split's length:
+    @param worker_id: id of the worker being started
+    @type worker_id: int
+    @param cpus: ids of the CPUs to run on
+    @type cpus: [int]
+    @param num_workers: number of workers of the dataloader
+    @type num_workers: int
+    '''
+    seed_worker(worker_id)
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(max(1, len(cpus) // num_workers))
 
-      with set_split_id('validate'):
-          avg_val_accuracy = total_eval_accuracy / len(dataloader)
-          
-    The above temporarily sets the dataloader's split
-    to 'validate' for the duration of the 'with' body.
-    Then the split is returned to the original value.
+#------------------------------------
+# gpu_cpu_affinity 
+#-------------------
+
+def gpu_cpu_affinity(gpu_id):
+    '''
+    Return the ids of the CPUs on the NUMA node to 
+    which the given GPU is attached, as the kernel lists
+    them for the GPU's PCI device. The GPU is looked up by
+    its PCI address, so the result is right whatever the 
+    CUDA_VISIBLE_DEVICES and CUDA_DEVICE_ORDER settings.
+    Only CPUs this process may run on are included.
     
-    @param dataloader: dataloader whose split is to be 
-        temporarily changed. 
-    @type dataloader: BertFeederDataloader
-    @param tmp_split_id: the split id to which the dataloader
-        is to be set for the scope of the with statement
-    @type tmp_split_id: {'train'|'validate'|'test'}
+    @param gpu_id: CUDA device index of the GPU
+    @type gpu_id: int
+    @return: list of CPU ids, or None if the topology
+        is not available
+    @rtype: {None|[int]}
     '''
-    saved_split_id = dataloader.curr_split()
-    dataloader.switch_to_split(tmp_split_id)
     try:
-        yield
-    finally:
-        dataloader.switch_to_split(saved_split_id)
+        props = torch.cuda.get_device_properties(gpu_id)
+        # GPUs are function 0 of their PCI device:
+        pci_addr = f"{props.pci_domain_id:04x}:{props.pci_bus_id:02x}:{props.pci_device_id:02x}.0"
+        with open(f"/sys/bus/pci/devices/{pci_addr}/local_cpulist") as fd:
+            cpu_list = fd.read().strip()
+    except (AssertionError, RuntimeError, AttributeError, OSError):
+        # No CUDA, or not Linux:
+        return None
+
+    # Such as '0-15,32-47':
+    cpus = set()
+    try:
+        for cpu_range in cpu_list.split(','):
+            low, _sep, high = cpu_range.partition('-')
+            cpus.update(range(int(low), int(high or low) + 1))
+    except ValueError:
+        return None
+    cpus &= os.sched_getaffinity(0)
+    return sorted(cpus) if cpus else None
+
+#------------------------------------
+# collate_presliced 
+#-------------------
+
+def collate_presliced(batch):
+    '''
+    Collate function for datasets with a __getitems__()
+    method that already returns a whole batch as a dict 
+    of tensors (see FrozenDataset). Such batches are passed
+    through unchanged. Lists of individual samples, as 
+    produced by datasets without preloaded arrays, are
+    collated by pytorch's default_collate().
+    
+    @param batch: a batch dict, or a list of sample dicts
+    @type batch: {dict|list}
+    @return: dict of batch tensors
+    @rtype: {str : torch.Tensor}
+    '''
+    if isinstance(batch, dict):
+        return batch
+    return default_collate(batch)
 
+#------------------------------------
+# seed_worker 
+#-------------------
+
+def seed_worker(_worker_id):
+    '''
+    Worker init function for dataloaders. Pytorch
+    seeds each worker's torch RNG with a base seed plus
+    the worker id. Derive the numpy and Python RNG 
+    seeds from that value, so that workers draw
+    different, but reproducible random numbers.
+    
+    @param _worker_id: id of the worker being started
+    @type _worker_id: int
+    '''
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+#------------------------------------
+# to_device 
+#-------------------
+
+def to_device(batch, device):
+    '''
+    Move every tensor in a batch to the given device.
+    Copies are issued with non_blocking=True, which lets 
+    them proceed asynchronously if the batch resides in
+    pinned memory (see MultiprocessingDataloader). Non-tensor
+    values are returned unchanged.
+    
+    @param batch: a batch as delivered by a dataloader 
+    @type batch: {dict|list|tuple|torch.Tensor}
+    @param device: target device, such as a cuda device number
+    @type device: {int|str|torch.device}
+    @return: the batch, with its tensors on the device
+    @rtype: same as batch
+    '''
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return {key : to_device(val, device) for key, val in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(val, device) for val in batch)
+    return batch
@@ -7,14 +7,18 @@ Created on Jun 11, 2020
 import ast
 from collections import deque
 import csv
+import hashlib
 import os
 import re
+import shutil
 from sqlite3 import OperationalError as DatabaseError
 import sqlite3
 import subprocess
 import sys
+import tempfile
 
 from pandas.core.frame import DataFrame
+import torch
 from torch.utils.data import Dataset
 
 import numpy as np
@@ -30,26 +34,330 @@ class FrozenDataset(Dataset):
 
     SPACE_TO_COMMA_PAT = re.compile(r'([0-9])[\s]+')
     
+    # Arrays filled by load_split(), and saved
+    # by load_cached_split():
+    CACHED_ARRAYS = ['sample_id_arr', 'tok_ids', 'attention_masks', 'labels', 'lengths']
+    
+    # Batch widths are rounded up to a multiple of this
+    # many columns (see __getitems__()). 1: no rounding:
+    width_multiple = 1
+    
     #------------------------------------
     # Constructor
     #-------------------
 
     def __init__(self,
                  log,
-                 db,
+                 db_path,
                  split_id,
                  queue,
                  label_mapping,
-                 sample_ids
+                 sample_ids,
+                 cache_dir=None,
+                 rebuild_cache=False
                  ):
+        '''
+        A read-only view of one split (train/validate/test)
+        of an SqliteDataset.
+        
+        Instances are handed to dataloader worker processes.
+        Sqlite connections may not be shared across processes,
+        and cannot be pickled. So only the path to the db is 
+        kept here; each process opens its own connection on 
+        first access to self.db.
+        
+        All samples of the split are read from the db once,
+        at construction time, into three contiguous arrays:
+        
+            self.tok_ids          [num_samples, sequence_len]
+            self.attention_masks  [num_samples, sequence_len]
+            self.labels           [num_samples]
+        
+        Row i holds the i'th sample of the split's queue.
+        __getitem__() then only slices these arrays, rather 
+        than querying the db and parsing the stringified
+        token id arrays for every sample.
+        
+        To cut memory and host-to-GPU transfer volume, token
+        ids are held as int16 (the BERT vocab has about 30k 
+        entries; int32 for larger vocabularies), attention 
+        masks as bool, and labels as int8. Consumers widen token ids and labels to int64 
+        after moving them to the GPU.
+        
+        If a cache_dir is given, the arrays are saved there
+        as .npy files after the first load from the db.
+        Later instances for the same db content and split
+        memory-map those files instead of parsing the db.
+        Dataloader workers then share the arrays' pages 
+        through the OS page cache. 
+        
+        @param log: logging service to use
+        @type log: LoggingService
+        @param db_path: path to the Sqlite db that holds the samples
+        @type db_path: str
+        @param split_id: one of 'train', 'validate', 'test'
+        @type split_id: str
+        @param queue: sample ids that make up this split
+        @type queue: deque
+        @param label_mapping: mapping from text labels to ints
+        @type label_mapping: OrderedDict({str : int})
+        @param sample_ids: all sample ids of the underlying dataset
+        @type sample_ids: [int]
+        @param cache_dir: directory for the split's array cache. 
+            None: no caching
+        @type cache_dir: {None|str}
+        @param rebuild_cache: if True, replace any existing cache
+            entry with arrays freshly read from the db
+        @type rebuild_cache: bool
+        '''
         self.log = log
-        self.db = db
+        self.db_path = db_path
+        self._db = None
+        self._db_pid = None
         self._split_id = split_id
         self.label_mapping = label_mapping
         self.sample_ids = sample_ids
                 
         self.queue = queue
         self.saved_queue = queue.copy()
+        
+        self.cache_path = None
+        if cache_dir is None:
+            self.load_split()
+        else:
+            self.load_cached_split(cache_dir, rebuild=rebuild_cache)
+
+    #------------------------------------
+    # load_split
+    #-------------------
+
+    def load_split(self):
+        '''
+        Read all samples of this split from the db 
+        into the arrays self.sample_id_arr, self.tok_ids, 
+        self.attention_masks, and self.labels. Order is
+        that of self.saved_queue. Also sets self.lengths
+        to the number of non-padding tokens of each sample.
+        '''
+        # Position of each sample in this split:
+        positions = {int(sample_id) : pos 
+                     for (pos, sample_id) in enumerate(self.saved_queue)}
+        num_samples = len(positions)
+
+        self.sample_id_arr = np.array(list(positions.keys()), dtype=np.int64)
+        self.labels = np.zeros(num_samples, dtype=np.int64)
+        self.tok_ids = None
+        self.attention_masks = None
+
+        res = self.db.execute('''
+                              SELECT sample_id, tok_ids, attention_mask, label
+                                FROM Samples
+                              ''')
+        for row in res:
+            try:
+                pos = positions[row['sample_id']]
+            except KeyError:
+                # Sample belongs to another split:
+                continue
+            tok_ids = self.to_np_array(row['tok_ids'])
+            if self.tok_ids is None:
+                # Now we know the sequence length. Token
+                # ids are collected as int64, and narrowed
+                # below to the smallest type that holds them:
+                self.tok_ids = np.zeros((num_samples, len(tok_ids)), dtype=np.int64)
+                self.attention_masks = np.zeros((num_samples, len(tok_ids)), dtype=np.bool_)
+            self.tok_ids[pos] = tok_ids
+            self.attention_masks[pos] = self.to_np_array(row['attention_mask'])
+            self.labels[pos] = row['label']
+
+        if self.tok_ids is None:
+            # Empty split:
+            self.tok_ids = np.zeros((0,0), dtype=np.int16)
+            self.attention_masks = np.zeros((0,0), dtype=np.bool_)
+        elif self.tok_ids.max(initial=0) <= np.iinfo(np.int16).max:
+            self.tok_ids = self.tok_ids.astype(np.int16)
+        elif self.tok_ids.max(initial=0) <= np.iinfo(np.int32).max:
+            # Larger vocabularies, such as multilingual BERT's:
+            self.tok_ids = self.tok_ids.astype(np.int32)
+        
+        # Label encodings are small ints, one per class:
+        if self.labels.max(initial=0) <= np.iinfo(np.int8).max:
+            self.labels = self.labels.astype(np.int8)
+
+        # For bucketing samples of similar length:
+        self.lengths = self.attention_masks.sum(axis=1)
+
+    #------------------------------------
+    # load_cached_split
+    #-------------------
+
+    def load_cached_split(self, cache_dir, rebuild=False):
+        '''
+        Memory-map this split's arrays from the cache 
+        under cache_dir. If not cached yet, read them
+        from the db via load_split(), and save them first.
+        
+        The cache entry's name is derived from a hash of 
+        the Samples table's content (see content_hash()), 
+        and from the split's sample ids. Changing the samples,
+        the tokenizer, the sequence length, or the split 
+        therefore leads to a new entry. The db file's 
+        modification time is not used: split_dataset() saves 
+        the queues to the db, and CSV sources are re-imported, 
+        on every run.
+        
+        @param cache_dir: root directory of the cache
+        @type cache_dir: str
+        @param rebuild: if True, the arrays are read from the
+            db again, and replace those of an existing entry
+        @type rebuild: bool
+        '''
+        key = hashlib.sha1()
+        key.update(self.content_hash(self.db).encode())
+        key.update(np.array(self.saved_queue, dtype=np.int64).tobytes())
+        self.cache_path = os.path.join(cache_dir, 
+                                       f"{self._split_id}_{key.hexdigest()[:16]}")
+        
+        if rebuild or not os.path.exists(self.cache_path):
+            if rebuild:
+                self.log.info(f"Rebuilding {self._split_id} split cache {self.cache_path}")
+            self.load_split()
+            # Write into a fresh temporary dir, and move it into 
+            # place when done, so that processes that build the 
+            # same entry concurrently never see a partial one:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix=f"{os.path.basename(self.cache_path)}.",
+                                        suffix='.tmp',
+                                        dir=cache_dir)
+            for arr_name in self.CACHED_ARRAYS:
+                np.save(os.path.join(tmp_path, f"{arr_name}.npy"), 
+                        getattr(self, arr_name))
+            try:
+                os.rename(tmp_path, self.cache_path)
+            except OSError:
+                # The entry exists; another process finished
+                # first. A rebuild replaces the entry's files 
+                # one by one, never removing them: each replace
+                # is atomic, so other processes and their workers,
+                # which map the files by name, always find 
+                # complete arrays:
+                if rebuild:
+                    for arr_name in self.CACHED_ARRAYS:
+                        os.replace(os.path.join(tmp_path, f"{arr_name}.npy"),
+                                   os.path.join(self.cache_path, f"{arr_name}.npy"))
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            self.log.info(f"Loading {self._split_id} split from cache {self.cache_path}")
+        
+        self.map_cached_arrays()
+
+    #------------------------------------
+    # content_hash
+    #-------------------
+
+    @staticmethod
+    def content_hash(db):
+        '''
+        Return a hash over the sample ids, token ids, 
+        attention masks, and labels in the Samples table.
+        The hash is computed once, and kept in table 
+        SamplesHash. SqliteDataset.process_csv_file() does 
+        so right after importing; dbs created before that 
+        get their hash on first use here. After editing 
+        the Samples table by other means, drop SamplesHash.
+        
+        @param db: connection to the db
+        @type db: sqlite3.Connection
+        @return: hex digest of the table's content
+        @rtype: str
+        '''
+        try:
+            return db.execute('SELECT content_hash FROM SamplesHash').fetchone()[0]
+        except (DatabaseError, TypeError):
+            # No hash saved yet:
+            pass
+        
+        key = hashlib.sha1()
+        res = db.execute('''
+                         SELECT sample_id, tok_ids, attention_mask, label
+                           FROM Samples
+                          ORDER BY sample_id
+                         ''')
+        for (sample_id, tok_ids, attention_mask, label) in res:
+            key.update(f"{sample_id}|{tok_ids}|{attention_mask}|{label}\n".encode())
+        content_hash = key.hexdigest()
+        
+        db.execute('DROP TABLE IF EXISTS SamplesHash')
+        db.execute('CREATE TABLE SamplesHash (content_hash text)')
+        db.execute('INSERT INTO SamplesHash VALUES(?)', (content_hash,))
+        db.commit()
+        return content_hash
+
+    #------------------------------------
+    # map_cached_arrays
+    #-------------------
+
+    def map_cached_arrays(self):
+        '''
+        Memory-map the arrays from self.cache_path. Copy-on-write,
+        so tensors created from the arrays are writable, 
+        without ever modifying the cache files.
+        '''
+        for arr_name in self.CACHED_ARRAYS:
+            setattr(self, 
+                    arr_name, 
+                    np.load(os.path.join(self.cache_path, f"{arr_name}.npy"), 
+                            mmap_mode='c'))
+
+    #------------------------------------
+    # db
+    #-------------------
+
+    @property
+    def db(self):
+        '''
+        Return an Sqlite connection that belongs to
+        the current process. Opened lazily, so that a
+        forked worker never uses its parent's connection.
+        '''
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path)
+            self._db.row_factory = sqlite3.Row
+            self._db_pid = os.getpid()
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+        self._db_pid = os.getpid()
+
+    #------------------------------------
+    # __getstate__
+    #-------------------
+
+    def __getstate__(self):
+        '''
+        Leave out the db connection when pickling
+        for spawned worker processes. Memory-mapped
+        arrays are re-mapped by the receiver, rather 
+        than copied. 
+        '''
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_db_pid'] = None
+        if self.cache_path is not None:
+            for arr_name in self.CACHED_ARRAYS:
+                del state[arr_name]
+        return state
+
+    #------------------------------------
+    # __setstate__
+    #-------------------
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache_path is not None:
+            self.map_cached_arrays()
 
     #------------------------------------
     # split_id
@@ -145,24 +453,65 @@ class FrozenDataset(Dataset):
 
     def __getitem__(self, indx):
         '''
-        Return indx'th row from the db.
-        The entire queue is always used,
-        rather than the remaining queue
-        after some popleft() ops. 
+        Return indx'th sample of the split from the
+        preloaded arrays. The entire queue is always used,
+        rather than the remaining queue after some 
+        popleft() ops. 
         
-        @param indx:
-        @type indx:
+        The returned tensors share memory with the 
+        preloaded arrays, rather than being copies. 
+        Callers must therefore not modify them in place.
+        
+        @param indx: position of the sample in this split
+        @type indx: int
+        @return: dict of tensors for one sample
+        @rtype: {str : torch.Tensor}
         '''
+        return {'sample_id'      : torch.as_tensor(self.sample_id_arr[indx]),
+                'tok_ids'        : torch.from_numpy(self.tok_ids[indx]),
+                'attention_mask' : torch.from_numpy(self.attention_masks[indx]),
+                'label'          : torch.as_tensor(self.labels[indx])
+                }
 
-        ith_sample_id = self.saved_queue[indx]
-        res = self.db.execute(f'''
-                               SELECT sample_id, tok_ids,attention_mask,label
-                                FROM Samples 
-                               WHERE sample_id = {ith_sample_id}
-                             ''')
-        # Return the (only result) row:
-        row = next(res)
-        return self.clean_row_res(dict(row))
+    #------------------------------------
+    # __getitems__ 
+    #-------------------
+
+    def __getitems__(self, indices):
+        '''
+        Return an entire batch at once. Pytorch dataloaders
+        call this method, if present, with the list of 
+        sample indices of one batch. Each preloaded array is 
+        gathered with a single fancy-index operation, so no
+        per-sample dicts need to be built and collated. Use 
+        bert_feeder_dataloader.collate_presliced() as the 
+        dataloader's collate_fn.
+        
+        Token ids and masks are cut off after the batch's 
+        last non-padding column, so BERT does no work on 
+        columns that are padding for every sample. Batching 
+        samples of similar length (see BucketBatchSampler)
+        makes this cut large. The width is then rounded up 
+        to a multiple of width_multiple, so that only a few
+        distinct widths occur.
+        
+        Fancy indexing already copies, so the tensors 
+        wrap the gathered arrays without another copy.
+        
+        @param indices: indices of the batch's samples in this split
+        @type indices: [int]
+        @return: dict of tensors, each with the batch as first dimension
+        @rtype: {str : torch.Tensor}
+        '''
+        masks = self.attention_masks[indices]
+        used_cols = np.flatnonzero(masks.any(axis=0))
+        width = used_cols[-1] + 1 if len(used_cols) > 0 else masks.shape[1]
+        width = min(-(-width // self.width_multiple) * self.width_multiple, masks.shape[1])
+        return {'sample_id'      : torch.from_numpy(self.sample_id_arr[indices]),
+                'tok_ids'        : torch.from_numpy(self.tok_ids[indices, :width]),
+                'attention_mask' : torch.from_numpy(masks[:, :width]),
+                'label'          : torch.from_numpy(self.labels[indices])
+                }
     
     #------------------------------------
     # __iter__ 
@@ -177,9 +526,7 @@ class FrozenDataset(Dataset):
     
     def __len__(self):
         '''
-        Return length of the current split. Use
-        switch_to_split() before calling this
-        method to get another split's length.
+        Return length of this split.
         The length of the entire queue is returned,
         not just what remains after calls to next()
         '''
@@ -220,6 +567,8 @@ class SqliteDataset(FrozenDataset):
                  sequence_len=None,
                  text_col_name=None,
                  label_col_name=None,
+                 cache_dir=None,
+                 rebuild_cache=False
                  ):
         '''
         A dataset for the context of Bert training.        
@@ -239,10 +588,11 @@ class SqliteDataset(FrozenDataset):
         
         An additional feature is the option for integrated
         train/validation/test splits. Calling split_dataset()
-        internally produces input queues that feed three 
-        iterators. Callers switch between these iterators via
-        the switch_to_split() method. The splits can be reset
-        to their beginnings using the reset() method.
+        creates one read-only FrozenDataset for each split.
+        Retrieve them via get_datasplit(), and hand each to
+        its own dataloader (see bert_feeder_dataloader.make_loaders()).
+        Indexing and iterating this instance itself covers 
+        all samples, regardless of splits.
         
         Takes a CSV file, and generates an Sqlite database
         that holds the integer indexes of the collection
@@ -300,6 +650,13 @@ class SqliteDataset(FrozenDataset):
         @type text_col_name: str
         @param label_col_name: CSV column that holds labels.
         @type label_col_name: str
+        @param cache_dir: directory in which the splits cache
+            their preloaded arrays. See FrozenDataset. None:
+            no caching
+        @type cache_dir: {None|str}
+        @param rebuild_cache: if True, the splits replace their
+            cache entries, rather than using them
+        @type rebuild_cache: bool
         @param quiet: don't ask for confirmation about existing sqlite file:
         @type quiet: bool
         @param delete_db: if True, delete Sqlite db that contains the csv
@@ -321,6 +678,8 @@ class SqliteDataset(FrozenDataset):
             self.text_col_name = text_col_name
 
         self.label_mapping = label_mapping
+        self.cache_dir = cache_dir
+        self.rebuild_cache = rebuild_cache
 
         if not os.path.exists(csv_or_sqlite_path):
             raise IOError(f"Data source {csv_or_sqlite_path} does not exist.")
@@ -334,6 +693,7 @@ class SqliteDataset(FrozenDataset):
             sqlite_path = file_path + '.sqlite'
             if os.path.exists(sqlite_path):
                 os.remove(sqlite_path)
+            self.db_path = sqlite_path
             # Fill the sqlite db with records, each
             # containing sample_id, toc_ids, label, attention_mask.
             self.db = self.process_csv_file(csv_or_sqlite_path,
@@ -344,24 +704,20 @@ class SqliteDataset(FrozenDataset):
                                             )
                 
         else:
-            self.db = sqlite3.connect(csv_or_sqlite_path)
-            self.db.row_factory = sqlite3.Row
+            self.db_path = csv_or_sqlite_path
+            self.db = self.open_for_writing(csv_or_sqlite_path)
 
         num_samples_row = next(self.db.execute('''SELECT COUNT(*) AS num_samples from Samples'''))
         num_samples = num_samples_row['num_samples']
         # Sqlite3 ROWIDs go from 1 to n
         self.sample_ids = list(range(num_samples))
 
-        # Make a preliminary train queue with all the
-        # sample ids. If split_dataset() is called later,
-        # this queue will be replaced:
-        self.train_queue = deque(self.sample_ids)
-        self.curr_queue  = self.train_queue
-        self.saved_queues = {}
-        # Again: this saved_queues entry will be
-        # replaced upon a split:
-        self.saved_queues['train'] = self.train_queue.copy()
-        self.num_samples = len(self.train_queue)
+        # Queue of all the sample ids for use of
+        # this instance as a stream; the splits 
+        # get their own queues in split_dataset():
+        self.queue = deque(self.sample_ids)
+        self.saved_queue = self.queue.copy()
+        self.num_samples = len(self.queue)
 
     #------------------------------------
     # train_set 
@@ -377,76 +733,6 @@ class SqliteDataset(FrozenDataset):
         else:
             raise ValueError("Only train, validate, and test are valid split ids.")
 
-    #------------------------------------
-    # switch_to_split 
-    #-------------------
-    
-    def switch_to_split(self, split_id):
-        
-        if split_id == 'train':
-            self.curr_queue = self.train_queue
-        elif split_id == 'validate':
-            self.curr_queue = self.val_queue
-        elif split_id == 'test':
-            self.curr_queue = self.test_queue
-        else:
-            raise ValueError(f"Dataset ID must be one of train/validate/test; was {split_id}")
-
-    #------------------------------------
-    # curr_dataset_id 
-    #-------------------
-
-    def curr_split_id(self):
-        if self.curr_queue == self.train_queue:
-            return 'train'
-        if self.curr_queue == self.val_queue:
-            return 'validate'
-        if self.curr_queue == self.test_queue:
-            return 'test'
-        raise ValueError("Bad curr_queue")
-        
-    #------------------------------------
-    # reset
-    #-------------------
-
-    def reset(self, split_id=None):
-        '''
-        Sets the dataset's queue to the beginning.
-        If dataset_id is None, resets the current
-        split.
-                
-        @param split_id:
-        @type split_id:
-        '''
-
-        # After replenishing the requested
-        # queue, check whether that queue was
-        # self.curr_queue. If so, change self.curr_queue
-        # to point to the new, refilled queue. Else
-        # self.curr_queue remains unchanged:
-                
-        if split_id == 'train':
-            old_train = self.train_queue
-            self.train_queue = self.saved_queues['train'].copy()
-            if self.curr_queue == old_train:
-                self.curr_queue = self.train_queue
-
-        elif split_id == 'validate':
-            old_val = self.val_queue
-            self.val_queue = self.saved_queues['validate'].copy()
-            if self.curr_queue == old_val:
-                self.curr_queue = self.val_queue
-            
-        elif split_id == 'test':
-            old_test = self.test_queue
-            self.test_queue = self.saved_queues['test'].copy()
-            if self.curr_queue == old_test:
-                self.curr_queue = self.test_queue
-
-        else:
-            raise ValueError(f"Dataset ID must be one of train/validate/test; was {split_id}")
-
-
     #------------------------------------
     # process_csv_file 
     #-------------------
@@ -503,10 +789,10 @@ class SqliteDataset(FrozenDataset):
         # Returns something line: b'   23556 /Users/foo.csv':
         (num_csv_lines, _filename) = res.stdout.decode().strip().split(' ')
         csv_fd = open(csv_path, 'r')
-        db = sqlite3.connect(sqlite_path)
-        db.row_factory = sqlite3.Row
+        db = self.open_for_writing(sqlite_path)
 
         db.execute('''DROP TABLE IF EXISTS Samples''')
+        db.execute('''DROP TABLE IF EXISTS SamplesHash''')
         db.execute('''
                    CREATE TABLE Samples (
                       sample_id int primary key,
@@ -515,6 +801,16 @@ class SqliteDataset(FrozenDataset):
                       label int
                       )
                    ''')
+        insert_cmd = '''INSERT INTO Samples (sample_id,
+                                                tok_ids, 
+                                                attention_mask, 
+                                                label
+                                                ) 
+                            VALUES (?,?,?,?)
+                     '''
+        # Rows are inserted in bulk, one transaction
+        # per 1000 rows:
+        pending_rows = []
         num_processed = 0
         try:
             self.reader = csv.DictReader(csv_fd)
@@ -534,55 +830,31 @@ class SqliteDataset(FrozenDataset):
                     # An error in the CSV file; next_csv_row()
                     # already wrote an error msg. Keep going
                     continue
-                insert_cmd = f'''
-                           INSERT INTO Samples (sample_id,
-                                                tok_ids, 
-                                                attention_mask, 
-                                                label
-                                                ) 
-                            VALUES (
-                              {num_processed},
-                              '{str(row_dict['tok_ids'])}',
-                              '{str(row_dict['attention_mask'])}',
-                              {row_dict['label']}
-                              )
-                           '''
-                db.execute(insert_cmd)
+                pending_rows.append((num_processed,
+                                     str(row_dict['tok_ids']),
+                                     str(row_dict['attention_mask']),
+                                     row_dict['label']
+                                     ))
                 num_processed += 1
                 #************
                 if TESTING:
                     if num_processed >= 10000:
-                        db.commit()
-    
                         break
                 #************
                 if num_processed % 1000 == 0:
+                    db.executemany(insert_cmd, pending_rows)
                     db.commit()
+                    pending_rows = []
                     self.log.info(f"Processed {num_processed}/{num_csv_lines} CSV records")
         finally:
+            db.executemany(insert_cmd, pending_rows)
             db.commit()
             csv_fd.close()
 
+        # Identifies this content to the split caches:
+        FrozenDataset.content_hash(db)
         return db
     
-    #------------------------------------
-    # __next__ 
-    #-------------------
-
-    def __next__(self):
-        try:
-            next_sample_id = self.curr_queue.popleft()
-        except IndexError:
-            raise StopIteration
-        
-        res = self.db.execute(f'''
-                               SELECT sample_id, tok_ids,attention_mask,label
-                                FROM Samples 
-                               WHERE sample_id = {next_sample_id}
-                             ''')
-        row = next(res)
-        return self.clean_row_res(dict(row))
-    
     #------------------------------------
     # __getitem__ 
     #-------------------
@@ -598,7 +870,7 @@ class SqliteDataset(FrozenDataset):
         @type indx:
         '''
 
-        ith_sample_id = self.saved_queues[self.curr_split_id()][indx]
+        ith_sample_id = self.sample_ids[indx]
         res = self.db.execute(f'''
                                SELECT sample_id, tok_ids,attention_mask,label
                                 FROM Samples 
@@ -607,6 +879,20 @@ class SqliteDataset(FrozenDataset):
         # Return the (only result) row:
         row = next(res)
         return self.clean_row_res(dict(row))
+
+    #------------------------------------
+    # __getitems__ 
+    #-------------------
+
+    def __getitems__(self, indices):
+        '''
+        No preloaded arrays here, so return the 
+        batch as a list of individual samples.
+        
+        @param indices: indices of the batch's samples
+        @type indices: [int]
+        '''
+        return [self[indx] for indx in indices]
     
     #------------------------------------
     # __iter__ 
@@ -621,13 +907,11 @@ class SqliteDataset(FrozenDataset):
     
     def __len__(self):
         '''
-        Return length of the current split. Use
-        switch_to_split() before calling this
-        method to get another split's length.
-        The length of the entire queue is returned,
-        not just what remains after calls to next()
+        Return the number of all samples, regardless
+        of splits. Not just what remains after calls 
+        to next()
         '''
-        return len(self.saved_queues[self.curr_split_id()])
+        return len(self.sample_ids)
 
     #------------------------------------
     # next_csv_row
@@ -796,8 +1080,6 @@ class SqliteDataset(FrozenDataset):
         self.val_queue = deque(perm[train_end:validate_end])
         self.test_queue = deque(perm[validate_end:])
         
-        self.curr_queue = self.train_queue
-        
         if save_to_db:
             self.save_queues(self.train_queue, self.val_queue, self.test_queue) 
         
@@ -807,27 +1089,33 @@ class SqliteDataset(FrozenDataset):
         self.saved_queues['test'] = self.test_queue.copy()
         
         self.train_frozen_dataset = FrozenDataset(self.log,
-                                                  self.db,
+                                                  self.db_path,
                                                   'train',
                                                   self.saved_queues['train'],
                                                   self.label_mapping,
-                                                  self.sample_ids
+                                                  self.sample_ids,
+                                                  cache_dir=self.cache_dir,
+                                                  rebuild_cache=self.rebuild_cache
                                                   )
         
         self.validate_frozen_dataset = FrozenDataset(self.log,
-                                                     self.db,
+                                                     self.db_path,
                                                      'validate',
                                                      self.saved_queues['validate'],
                                                      self.label_mapping,
-                                                     self.sample_ids
+                                                     self.sample_ids,
+                                                     cache_dir=self.cache_dir,
+                                                     rebuild_cache=self.rebuild_cache
                                                      )
         
         self.test_frozen_dataset = FrozenDataset(self.log,
-                                                 self.db,
+                                                 self.db_path,
                                                  'test',
                                                  self.saved_queues['test'],
                                                  self.label_mapping,
-                                                 self.sample_ids
+                                                 self.sample_ids,
+                                                 cache_dir=self.cache_dir,
+                                                 rebuild_cache=self.rebuild_cache
                                                  )
         
     #------------------------------------
@@ -850,6 +1138,32 @@ class SqliteDataset(FrozenDataset):
         return row
         return (self.train_queue, self.val_queue, self.test_queue)
 
+    #------------------------------------
+    # open_for_writing
+    #-------------------
+
+    def open_for_writing(self, db_path):
+        '''
+        Open a connection to the db for this instance
+        to write to. Sqlite then syncs to disk less often.
+        Only a power failure at the wrong moment could 
+        corrupt the db, which is easily recreated from 
+        the CSV file.
+        
+        The rollback journal is kept, rather than switching
+        to write-ahead logging, because WAL does not work
+        on network file systems. 
+        
+        @param db_path: path to the Sqlite db
+        @type db_path: str
+        @return: connection with rows returned as sqlite3.Row
+        @rtype: sqlite3.Connection
+        '''
+        db = sqlite3.connect(db_path)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
     #------------------------------------
     # save_queues 
     #-------------------
@@ -900,14 +1214,14 @@ class SqliteDataset(FrozenDataset):
         @param dict: col/value information to store
         @type dict: {str : <any-db-appropriate>}
         '''
+        # All in one transaction: a single commit,
+        # and thus a single sync to disk:
         if delete_existing:
             self.db.execute(f'''DROP TABLE IF EXISTS {table_name}''')
             self.db.execute(f'''CREATE TABLE {table_name} ('key_col' varchar(255),
                                                           'val_col' varchar(255));''')
-            self.db.commit()
 
-        insert_vals = list(the_dict.items())
-        self.db.executemany(f"INSERT INTO {table_name} VALUES(?,?);", insert_vals)
+        self.db.executemany(f"INSERT INTO {table_name} VALUES(?,?);", the_dict.items())
         self.db.commit()
 
     #------------------------------------
@@ -11,36 +11,30 @@ TODO:
 
 from _collections import OrderedDict
 import argparse
-import csv
+import contextlib
 import datetime
 import json
+import logging
 import os, sys
 import random
 import time
 import warnings
 
-import GPUtil
-from apex import amp
-from apex.parallel import DistributedDataParallel
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import classification_report 
-from sklearn.metrics import confusion_matrix 
-from sklearn.metrics import matthews_corrcoef
+# Transformers and sklearn take seconds to import. They
+# are imported where they are used, so that every launched
+# process, and runs that only prepare the data, do not pay
+# for them up front.
 from torch import nn, cuda
 import torch
-from transformers import AdamW, BertForSequenceClassification
-from transformers import get_linear_schedule_with_warmup
+from torch.nn.parallel import DistributedDataParallel
 
-from bert_feeder_dataloader import MultiprocessingDataloader
-from bert_feeder_dataloader import SqliteDataLoader
+from bert_feeder_dataloader import CudaPrefetcher, DeviceResidentLoader, make_loaders
 from bert_feeder_dataset import SqliteDataset
 from logging_service import LoggingService
 import numpy as np
 import torch.distributed as dist
 
 
-# Mixed floating point facility (Automatic Mixed Precision)
-# From Nvidia: https://nvidia.github.io/apex/amp.html
 sys.path.append(os.path.dirname(__file__))
 
 
@@ -96,22 +90,36 @@ class BertTrainer(object):
     LABEL_ENCODINGS=OrderedDict({'0'  : 0,
                                  '1'   : 1})
 
-    # Automatic Mixed Precision optimization setting:
-    
-    #   "00"  Pure 32-bit floating point (F32), therefore a no-op
-    #            Use to get lower speed, upper accuracy bound
-    #   "01"  Recommended: Mixed precision, amp figures out 
-    #           which methods should be run F16, and which F32
-    #   "02"  Also a mix; but does not patch pytorch or Tensor funcs
-    #   "03"  Pure F16. Fastest, but may not achieve stability.
-    #           Try out to get upper speed, lower accuracy bounds
-     
-    AMP_OPTIMIZATION_LEVEL = "O1"
-    
     # Device number for CPU (as opposed to GPUs, which 
     # are numbered as positive ints:
     CPU_DEV = -1
     
+    # DistributedDataParallel groups gradients into buckets
+    # of this many MB, and starts each bucket's AllReduce as
+    # soon as backward has filled it. BERT-base's gradients
+    # then go out in a few buckets, overlapped with the rest
+    # of the backward pass:
+    DDP_BUCKET_CAP_MB = 50
+    
+    # Whether to record GPU memory use at several points 
+    # of each training step (see history_checkpoint()). 
+    # Each reading synchronizes with the GPU, so this is
+    # only for hunting down out-of-memory crashes:
+    TRACK_GPU_MEMORY = False
+    
+    # Dataset splits are kept in GPU memory for the whole
+    # run if together they take up no more than this 
+    # fraction of the GPU's free memory. The rest is left
+    # for the model, its gradients, and activations:
+    GPU_RESIDENT_MAX_FRACTION = 0.3
+    
+    # When compiling with CUDA graphs, batches are bucketed
+    # by length, and their widths rounded up to a multiple 
+    # of this many tokens. Each distinct width records its
+    # own graph, with its own memory pool; with sequences of
+    # 128 tokens at most four widths remain:
+    CUDA_GRAPH_WIDTH_MULTIPLE = 32
+    
     #------------------------------------
     # Constructor 
     #-------------------
@@ -129,10 +137,54 @@ class BertTrainer(object):
                  logfile=None,
                  preponly=False,
                  started_from_launch=False,
-                 testing_cuda_on_cpu=False
+                 testing_cuda_on_cpu=False,
+                 gradient_accumulation_steps=1,
+                 gradient_checkpointing=False,
+                 compile_model=False,
+                 bf16=False,
+                 rebuild_cache=False,
+                 gpu_resident=True
                  ):
         '''
         Number of epochs: 2, 3, 4 
+        
+        With gradient_accumulation_steps > 1, the optimizer
+        steps once per that many batches, emulating a batch
+        size that does not fit into GPU memory.
+        
+        With gradient_checkpointing, activations inside the
+        BERT layers are recomputed during the backward pass,
+        rather than kept from the forward pass. That costs 
+        about a quarter more computation, but most of the 
+        activation memory, allowing larger batches.
+        
+        With compile_model, the model is compiled with
+        torch.compile, which fuses many of the small GPU 
+        kernels of each BERT layer. The first batches of 
+        each new sequence length run slower while compiling.
+        Passing 'reduce-overhead' rather than True for 
+        compile_model additionally records each compiled 
+        forward and backward as a CUDA graph, which is replayed 
+        with a single launch. Batches are then bucketed by 
+        length, and their widths rounded up to a multiple of 
+        CUDA_GRAPH_WIDTH_MULTIPLE, since each distinct batch 
+        shape records its own graph, and keeps its own GPU 
+        memory pool.
+        
+        With bf16, mixed precision computes in bfloat16 rather 
+        than float16. Bfloat16 has the exponent range of float32,
+        so gradients need no loss scaling. Requires an Ampere 
+        or newer GPU.
+        
+        With rebuild_cache, the train/validate/test splits are
+        read from the db again, replacing their entries in the
+        split cache next to the data source.
+        
+        With gpu_resident, dataset splits that fit into a
+        fraction of GPU memory are copied there once, and 
+        batches are gathered on the GPU (see keep_on_gpu()).
+        Loader workers, their NUMA pinning, and prefetching
+        to the GPU are then not used. 
         '''
         #************
 #         print(f"******WORLD_SIZE:{os.getenv('WORLD_SIZE')}")
@@ -172,7 +224,8 @@ class BertTrainer(object):
                                       self.label_encodings,
                                       text_col_name,
                                       label_col_name,
-                                      sequence_len
+                                      sequence_len,
+                                      rebuild_cache
                                       )
           
         # If only supposed to create the sqlite db, we are done
@@ -185,7 +238,7 @@ class BertTrainer(object):
             # We were not called via the launch.py script.
             # Check wether there is at least on 
             # local GPU, if so, use that:
-            if len(GPUtil.getGPUs()) > 0:
+            if cuda.device_count() > 0:
                 self.local_rank = 0
             else:
                 self.local_rank = None
@@ -207,12 +260,21 @@ class BertTrainer(object):
                 logfile = f"{logfile_root}_{self.local_rank}{ext}"
             self.log = LoggingService(logfile=logfile)
         
+        # Suppress the expected warning about lr_scheduler.step()
+        # before optimizer.step(). It comes when the GradScaler
+        # skips a step. Installed once, rather than around each
+        # scheduler step in the training loop:
+        warnings.filterwarnings('ignore',
+                                message="Detected call of [`]lr_scheduler.step()[`]*",
+                                category=UserWarning)
+        
         self.batch_size = batch_size
         self.epochs     = epochs
-        
-        # The following call also sets self.gpu_obj
-        # to a GPUtil.GPU instance, so we can check
-        # on the GPU status along the way:
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.gradient_checkpointing = gradient_checkpointing
+        self.compile_model = compile_model
+        self.bf16 = bf16
+        self.gpu_resident = gpu_resident
         
         self.gpu_device = self.enable_GPU(self.local_rank)
         if self.gpu_device != self.CPU_DEV and \
@@ -224,6 +286,10 @@ class BertTrainer(object):
             # WORLD_SIZE:
             try:
                 self.node_rank = int(os.environ['NODE_RANK'])
+                # Rank of this process among all processes on 
+                # all nodes. NODE_RANK is shared by all processes
+                # on a machine:
+                self.rank = int(os.environ['RANK'])
                 self.world_size = int(os.environ['WORLD_SIZE'])
                 self.master_addr = os.environ['MASTER_ADDR']
                 self.master_port = os.environ['MASTER_PORT']
@@ -241,6 +307,7 @@ class BertTrainer(object):
                     os.environ['WORLD_SIZE'] = '1'
                     os.environ['MASTER_ADDR'] = '127.0.0.1'
                     self.node_rank  = 0
+                    self.rank       = 0
                     self.world_size = 1
                     self.master_addr = '127.0.0.1'
                     
@@ -258,12 +325,35 @@ class BertTrainer(object):
             # to be 1, which is the CPU struggling along:
             self.world_size = 1
 
+        if self.gpu_device != self.CPU_DEV:
+            # Let float32 matrix multiplies that run outside 
+            # of autocast use TF32 tensor cores on Ampere or 
+            # newer GPUs. Older GPUs ignore this. The cuDNN 
+            # autotuner (cudnn.benchmark) is left off: batch 
+            # widths vary with each batch's longest sample,
+            # so it would re-tune for every new width:
+            torch.set_float32_matmul_precision('high')
+            torch.backends.cudnn.allow_tf32 = True
+
         if model_save_path is None:
             (self.csv_file_root, _ext) = os.path.splitext(csv_or_sqlite_path)
             self.model_save_path = self.csv_file_root + '_trained_model' + '.sav'
         else:
             self.model_save_path = model_save_path
             
+        # Set the seed value all over the place to make this reproducible.
+        # Once per process; each process gets its own seed, so
+        # that dropout masks differ among the processes. DDP 
+        # copies the initial weights from rank 0 to all processes,
+        # so the model still starts out identical everywhere:
+        seed_val = self.RANDOM_SEED + int(os.environ.get('RANK', 0))
+        
+        random.seed(seed_val)
+        np.random.seed(seed_val)
+        torch.manual_seed(seed_val)
+        # From torch:
+        cuda.manual_seed_all(seed_val)
+
         # Preparation:
 
         if self.testing_cuda_on_cpu:
@@ -271,41 +361,37 @@ class BertTrainer(object):
             self.gpu_device = 0
             self.world_size = 3
             self.node_rank  = 0
+            self.rank       = 0
 
        
         if self.gpu_device == self.CPU_DEV:
-
             # CPU bound, single machine:
-
-            self.train_dataloader = SqliteDataLoader(dataset.train_frozen_dataset,
-                                                     batch_size=self.batch_size
-                                                     )
-            self.val_dataloader = SqliteDataLoader(dataset.validate_frozen_dataset,
-                                                   batch_size=self.batch_size
-                                                   )
-                                                         
-            self.test_dataloader = SqliteDataLoader(dataset.validate_frozen_dataset,
-                                                    batch_size=self.batch_size
-                                                    )
-            
+            loaders = make_loaders(dataset, self.batch_size)
         else:
-            # GPUSs used, single or multiple machines:
-            
-            self.train_dataloader = MultiprocessingDataloader(dataset.train_frozen_dataset,
-                                                              self.world_size,
-                                                              self.node_rank, 
-                                                              batch_size=self.batch_size
-                                                              )
-            self.val_dataloader = MultiprocessingDataloader(dataset.validate_frozen_dataset,
-                                                            self.world_size,
-                                                            self.node_rank, 
-                                                            batch_size=self.batch_size
-                                                            )
-            self.test_dataloader = MultiprocessingDataloader(dataset.test_frozen_dataset,
-                                                             self.world_size,
-                                                             self.node_rank, 
-                                                             batch_size=self.batch_size
-                                                             )
+            # GPUSs used, single or multiple machines.
+            # Validation and test sets are not reshuffled
+            # each epoch. On a single machine the samplers 
+            # shard by the global rank; with the node rank, 
+            # all processes on a machine would train on the
+            # same samples. Across machines, see node_sharding():
+            sharding = self.node_sharding()
+            # With CUDA graphs, keep the number of distinct
+            # batch widths, and thus of recorded graphs, small:
+            cuda_graphs = self.compile_model == 'reduce-overhead'
+            loaders = make_loaders(dataset,
+                                   self.batch_size,
+                                   world_size=self.world_size,
+                                   gpu_id=self.gpu_device,
+                                   bucket_by_length=cuda_graphs,
+                                   width_multiple=self.CUDA_GRAPH_WIDTH_MULTIPLE if cuda_graphs else None,
+                                   **sharding
+                                   )
+            if self.gpu_resident and not self.testing_cuda_on_cpu:
+                loaders = self.keep_on_gpu(loaders)
+        self.train_dataloader = loaders['train']
+        self.val_dataloader   = loaders['validate']
+        self.test_dataloader  = loaders['test']
+
         if self.testing_cuda_on_cpu:
             self.gpu_device = self.CPU_DEV
 
@@ -339,7 +425,8 @@ class BertTrainer(object):
                        label_encodings,
                        text_col_name,
                        label_col_name,
-                       sequence_len
+                       sequence_len,
+                       rebuild_cache=False
                        ):
         '''
         Takes a csv or sqlite file pointer. If CSV,
@@ -359,6 +446,9 @@ class BertTrainer(object):
         @type label_col_name:
         @param sequence_len:
         @type sequence_len:
+        @param rebuild_cache: whether to replace the splits' 
+            cache entries
+        @type rebuild_cache: bool
         @return: dataset instance
         @rtype: torch.DataSet
         '''
@@ -369,6 +459,10 @@ class BertTrainer(object):
                                     text_col_name=text_col_name,
                                     label_col_name=label_col_name,
                                     sequence_len=sequence_len,
+                                    # Reuse parsed splits across runs:
+                                    cache_dir=os.path.join(os.path.dirname(csv_or_sqlite_path),
+                                                           'split_cache'),
+                                    rebuild_cache=rebuild_cache
                                     )
         except Exception as e:
             # Not recoverable
@@ -376,9 +470,8 @@ class BertTrainer(object):
 
         # Save the label_encodings dict in a db table,
         # but reversed: int-code ==> label-str
-        inverse_label_encs = OrderedDict()
-        for (key, val) in self.label_encodings.items():
-            inverse_label_encs[str(val)] = key
+        inverse_label_encs = OrderedDict((str(val), key) 
+                                         for (key, val) in self.label_encodings.items())
             
         dataset.save_dict_to_table('LabelEncodings', 
                                    inverse_label_encs, 
@@ -401,9 +494,17 @@ class BertTrainer(object):
             self.log.info(f"Awaiting {self.world_size} nodes to run...")
         else:
             self.log.info("Awaiting master node's response...")
+        # Let a hung collective raise after the timeout,
+        # rather than block all processes forever:
+        os.environ.setdefault('TORCH_NCCL_ASYNC_ERROR_HANDLING', '1')
+        # enable_GPU() has already made this process' GPU
+        # the current device. Binding NCCL to it right away
+        # avoids a lazy bind at the first collective:
         dist.init_process_group(
             backend='nccl',
-            init_method='env://'
+            init_method='env://',
+            timeout=datetime.timedelta(minutes=10),
+            device_id=torch.device('cuda', self.cuda_dev)
         )
         self.log.info("And we're off!")
 
@@ -417,10 +518,11 @@ class BertTrainer(object):
         available GPU. If none is exists on this 
         machine, returns self.CPU_DEV (-1).
         
-        Initializes self.gpu_obj, which is a CUDA
-        GPU instance. 
+        Initializes self.cuda_dev to the device id.
         
-        Initializes self.cuda_dev: f"cuda:{device_id}"
+        GPUs are queried via torch.cuda, which calls the 
+        CUDA driver directly, rather than running and 
+        parsing nvidia-smi, as GPUtil does.
         
         @param local_rank: which GPU to use. Created by the launch.py
             script. If None, just look for the next available GPU
@@ -434,16 +536,8 @@ class BertTrainer(object):
             raise_gpu_unavailable, and no GPU is available.
         '''
 
-        self.gpu_obj = None
-
-        # Get the GPU device name.
-        # Could be (GPU available):
-        #   device(type='cuda', index=0)
-        # or (No GPU available):
-        #   device(type=self.CPU_DEV)
-
-        gpu_objs = GPUtil.getGPUs()
-        if len(gpu_objs) == 0:
+        num_gpus = cuda.device_count()
+        if num_gpus == 0:
             return self.CPU_DEV
 
         # GPUs are installed. Did caller ask for a 
@@ -452,7 +546,6 @@ class BertTrainer(object):
         if local_rank is not None:
             # Sanity check: did caller ask for a non-existing
             # GPU id?
-            num_gpus = len(GPUtil.getGPUs())
             if num_gpus < local_rank + 1:
                 # Definitely an error, don't revert to CPU:
                 raise NoGPUAvailable(f"Request to use GPU {local_rank}, but only {num_gpus} available on this machine.")
@@ -462,16 +555,18 @@ class BertTrainer(object):
             return local_rank
         
         # Caller did not ask for a specific GPU. Are any 
-        # GPUs available, given their current memory/cpu 
-        # usage? We use the default maxLoad of 0.5 and 
-        # maxMemory of 0.5 as OK to use GPU:
+        # GPUs available, given their current memory 
+        # usage? A GPU with at least half its memory
+        # free is OK to use:
+        
+        device_id = None
+        for gpu_id in range(num_gpus):
+            (free_mem, total_mem) = cuda.mem_get_info(gpu_id)
+            if free_mem / total_mem > 0.5:
+                device_id = gpu_id
+                break
         
-        try:
-            # If a GPU is available, the following returns
-            # a one-element list of GPU ids. Else it throws
-            # an error:
-            device_id = GPUtil.getFirstAvailable()[0]
-        except RuntimeError:
+        if device_id is None:
             # If caller wants non-availability of GPU
             # even though GPUs are installed to be an 
             # error, throw one:
@@ -481,10 +576,6 @@ class BertTrainer(object):
                 # Else quietly revert to CPU
                 return self.CPU_DEV
         
-        # Get the GPU object that has the found
-        # deviceID:
-        self.gpu_obj_from_devid(device_id)
-        
         # Initialize a string to use for moving 
         # tensors between GPU and cpu with their
         # to(device=...) method:
@@ -492,16 +583,107 @@ class BertTrainer(object):
         return device_id 
 
     #------------------------------------
-    # gpu_obj_from_devid 
+    # gpu_memory 
     #-------------------
     
-    def gpu_obj_from_devid(self, devid):
+    def gpu_memory(self):
+        '''
+        Return free and used memory of this
+        process' GPU in MB.
+        
+        @return: free and used memory
+        @rtype: (int, int)
+        '''
+        (free_mem, total_mem) = cuda.mem_get_info(self.cuda_dev)
+        return (free_mem // 2**20, (total_mem - free_mem) // 2**20)
 
-        for gpu_obj in GPUtil.getGPUs():
-            if gpu_obj.id == devid:
-                self.gpu_obj = gpu_obj
-                break
-        return self.gpu_obj
+    #------------------------------------
+    # node_sharding 
+    #-------------------
+
+    def node_sharding(self):
+        '''
+        Return the make_loaders() arguments that decide how 
+        samples are divided among the processes. When training
+        across machines with the same number of processes on 
+        each, every machine keeps its share of the samples in 
+        all epochs (see NodeLocalDistributedSampler). That 
+        sampler takes the rank of the machine, and of the 
+        process within it. Else samples are sharded by the 
+        global rank.
+        
+        Process counts per machine come from LOCAL_WORLD_SIZE,
+        which launch.py sets. They are exchanged among all 
+        processes, so call only after init_multiprocessing().
+        
+        @return: keyword arguments for make_loaders()
+        @rtype: {str : int}
+        '''
+        procs_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', self.world_size))
+        if procs_per_node >= self.world_size:
+            return {'node_rank' : self.rank}
+
+        all_procs_per_node = [None] * self.world_size
+        dist.all_gather_object(all_procs_per_node, procs_per_node)
+        if len(set(all_procs_per_node)) > 1:
+            self.log.info("Unequal numbers of processes per machine; sharding samples by global rank")
+            return {'node_rank' : self.rank}
+        
+        return {'num_nodes'  : self.world_size // procs_per_node,
+                'node_rank'  : self.node_rank,
+                'local_rank' : self.local_rank
+                }
+
+    #------------------------------------
+    # keep_on_gpu 
+    #-------------------
+
+    def keep_on_gpu(self, loaders):
+        '''
+        If all dataset splits together fit into 
+        GPU_RESIDENT_MAX_FRACTION of this GPU's free memory, 
+        wrap each loader in a DeviceResidentLoader. Batches
+        are then gathered on the GPU, and never copied there.
+        Else return the loaders unchanged.
+        
+        @param loaders: dict mapping split names to loaders
+        @type loaders: {str : SqliteDataLoader}
+        @return: the loaders to use
+        @rtype: {str : {SqliteDataLoader|DeviceResidentLoader}}
+        '''
+        needed = sum(DeviceResidentLoader.nbytes(loader.dataset)
+                     for loader in loaders.values())
+        (free_mem, _total_mem) = cuda.mem_get_info(self.cuda_dev)
+        if needed > self.GPU_RESIDENT_MAX_FRACTION * free_mem:
+            self.log.info(f"Dataset ({needed // 2**20}MB) too large to keep on GPU; "
+                          "batches come from loader workers")
+            return loaders
+        self.log.info(f"Keeping dataset on GPU ({needed // 2**20}MB); "
+                      "loader workers and prefetching are not used")
+        return {split_id : DeviceResidentLoader(loader, self.cuda_dev)
+                for split_id, loader in loaders.items()}
+
+    #------------------------------------
+    # batches 
+    #-------------------
+
+    def batches(self, dataloader):
+        '''
+        Return an iterable over the dataloader's batches
+        that delivers them on the device used for training. 
+        On a GPU, a CudaPrefetcher copies the next batch 
+        while the current one is being processed. Loaders
+        that keep their data on the GPU are returned as is.
+        
+        @param dataloader: source of batches
+        @type dataloader: DataLoader
+        @return: iterable of batches on the training device
+        @rtype: {DataLoader|CudaPrefetcher|DeviceResidentLoader}
+        '''
+        if self.gpu_device == self.CPU_DEV or self.testing_cuda_on_cpu or \
+            isinstance(dataloader, DeviceResidentLoader):
+            return dataloader
+        return CudaPrefetcher(dataloader, self.cuda_dev)
 
     #------------------------------------
     # prepare_model 
@@ -528,38 +710,97 @@ class BertTrainer(object):
         @rtype: Schedule (?)
         '''
         
+        from transformers import BertForSequenceClassification
+        from transformers import get_linear_schedule_with_warmup
+        
         # Load BertForSequenceClassification, the pretrained BERT model with a single 
         # linear classification layer on top. 
         model = BertForSequenceClassification.from_pretrained(
             #"bert-large-uncased", # Use the 12-layer BERT model, with an uncased vocab.
             "bert-base-uncased",
-            num_labels = 3, # The number of output labels--2 for binary classification.
-                            # You can increase this for multi-class tasks.   
+            num_labels = len(self.label_encodings), # One output per label.
             output_attentions = False, # Whether the model returns attentions weights.
             output_hidden_states = False, # Whether the model returns all hidden-states.
+            return_dict = False, # Return (loss, logits) tuples, which the loops unpack.
+            low_cpu_mem_usage = True, # Load weights without first building a randomly 
+                                      # initialized copy; matters with one process per GPU.
         )
         
         # Tell pytorch to run this model on the GPU.
         if self.gpu_device != self.CPU_DEV:
             model = model.to(device=self.cuda_dev)
-        # Note: AdamW is a class from the huggingface library (as opposed to pytorch) 
+            
+        if self.gradient_checkpointing:
+            model.gradient_checkpointing_enable()
+            # Cached key/values are only for generation, 
+            # and incompatible with checkpointing:
+            model.config.use_cache = False
+
+        # Note: AdamW is Pytorch's (the huggingface version is deprecated)
         # I believe the 'W' stands for 'Weight Decay fix"
-        optimizer = AdamW(model.parameters(),
+        # On GPUs the fused implementation updates all parameters
+        # in a single kernel, instead of launching several kernels
+        # per parameter tensor. Elsewhere, the default multi-tensor 
+        # (foreach) implementation is used:
+        optimizer = torch.optim.AdamW(model.parameters(),
                                #lr = 2e-5, # args.learning_rate - default is 5e-5, our notebook had 2e-5
                                lr = learning_rate,
-                               eps = 1e-8 # args.adam_epsilon  - default is 1e-8.
+                               eps = 1e-8, # args.adam_epsilon  - default is 1e-8.
+                               weight_decay = 0.0, # The huggingface AdamW default
+                               fused = True if self.gpu_device != self.CPU_DEV else None
                                )
 
+        # Automatic Mixed Precision on GPUs: forward passes
+        # run under autocast, which picks F16 or F32 per op,
+        # and the GradScaler scales the loss so that small F16 
+        # gradients do not underflow. Both are no-ops when
+        # disabled, so the CPU path needs no special casing.
+        # BF16 gradients cannot underflow where F32 ones would
+        # not, so BF16 runs without the scaler:
+        self.use_amp = self.gpu_device != self.CPU_DEV
+        self.amp_dtype = torch.bfloat16 if self.bf16 else torch.float16
+        if self.use_amp and self.bf16 and not cuda.is_bf16_supported():
+            raise TrainError("Request for bf16 mixed precision, but GPU does not support bfloat16.")
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.use_amp and not self.bf16)
+
         if self.gpu_device != self.CPU_DEV:
-            # Allow Amp to perform casts as required by the opt_level
-            # Second AMP related change:
-            (model, optimizer) = amp.initialize(model, 
-                                                optimizer, 
-                                                opt_level=self.AMP_OPTIMIZATION_LEVEL)
-            model = DistributedDataParallel(model)
+            # Gradients are kept directly in the buckets
+            # (gradient_as_bucket_view), saving a copy into 
+            # the buckets and back for each step. All BERT
+            # parameters get gradients, so DDP need not 
+            # search for unused ones. Checkpointing reruns parts
+            # of the forward pass during backward, which DDP 
+            # only tolerates when told that the graph is the 
+            # same in every step (static_graph):
+            model = DistributedDataParallel(model, 
+                                            device_ids=[self.cuda_dev],
+                                            output_device=self.cuda_dev,
+                                            bucket_cap_mb=self.DDP_BUCKET_CAP_MB,
+                                            gradient_as_bucket_view=True,
+                                            find_unused_parameters=False,
+                                            static_graph=self.gradient_checkpointing
+                                            )
+
+        if self.compile_model:
+            # Compiled after the DDP wrap, so that the compiler
+            # splits the graph at DDP's bucket boundaries, and
+            # each bucket's AllReduce still overlaps with the 
+            # rest of the backward pass. Compiles in place, so 
+            # the model keeps its class and state_dict keys. 
+            # Batch widths vary with the longest sample in each 
+            # batch, so let the compiler generalize over sequence 
+            # length rather than recompile for every width. A 
+            # string selects the compile mode, such as 
+            # 'reduce-overhead' for CUDA graphs:
+            model.compile(dynamic=None,
+                          mode=self.compile_model if isinstance(self.compile_model, str) else None)
+
         # Total number of training steps is [number of batches] x [number of epochs]. 
         # (Note that this is not the same as the number of training samples).
-        total_steps = len(train_dataloader) * self.epochs
+        # With gradient accumulation, the optimizer steps once
+        # per gradient_accumulation_steps batches:
+        steps_per_epoch = -(-len(train_dataloader) // self.gradient_accumulation_steps)
+        total_steps = steps_per_epoch * self.epochs
         
         # Create the learning rate scheduler.
         scheduler = get_linear_schedule_with_warmup(optimizer, 
@@ -605,15 +846,6 @@ class BertTrainer(object):
         # This training code is based on the `run_glue.py` script here:
         # https://github.com/huggingface/transformers/blob/5bfcd0485ece086ebcbed2d008813037968a9e58/examples/run_glue.py#L128
         
-        # Set the seed value all over the place to make this reproducible.
-        seed_val = self.RANDOM_SEED
-        
-        random.seed(seed_val)
-        np.random.seed(seed_val)
-        torch.manual_seed(seed_val)
-        # From torch:
-        cuda.manual_seed_all(seed_val)
-        
         # We'll store a number of quantities such as training and validation train_loss, 
         # validation accuracy, and timings.
         self.training_stats = {'Training' : []}
@@ -621,7 +853,10 @@ class BertTrainer(object):
         # Measure the total training time for the whole run.
         total_t0 = time.time()
         
-        self.total_num_batches = round(len(self.train_dataloader) / (self.batch_size * self.world_size))
+        # Number of batches this process trains on per epoch.
+        # The sampler already gave this process only its share
+        # of the samples, so there is no division by world_size:
+        self.total_num_batches = len(self.train_dataloader)
         
         # For each epoch...
         for epoch_i in range(0, epochs):
@@ -649,10 +884,12 @@ class BertTrainer(object):
                 # samples in each epoch:
                 self.train_dataloader.set_epoch(epoch_i)
 
-            # When using a GPU, we check GPU memory 
-            # at critical moments, and store the result
-            # as a dict in the following list:
+            # When using a GPU, and TRACK_GPU_MEMORY is set, 
+            # we check GPU memory at critical moments, and store 
+            # the result as a dict in the following list:
             self.gpu_status_history = []
+            self.track_gpu_memory = self.TRACK_GPU_MEMORY and \
+                                    self.gpu_device != self.CPU_DEV
 
             (avg_train_loss, avg_train_accuracy) = self.train_one_epoch(epoch_i)
             
@@ -708,142 +945,176 @@ class BertTrainer(object):
             self.model.train()
 
             # For each batch of training data...
-            # Tell data loader to pull from the train sample queue,
-            # starting over:
-            self.train_dataloader.reset()
+            # Each pass over the dataloader draws a fresh
+            # sequence of indices from its sampler, so there
+            # is no need to reset the dataset's sample queue:
+            num_batches = self.total_num_batches
+            
+            if self.testing_cuda_on_cpu:
+                self.gpu_device = self.CPU_DEV
+            
+            # Bind what stays the same for the whole epoch to
+            # locals, rather than looking up attributes of self
+            # several times in every step:
+            on_gpu = self.gpu_device != self.CPU_DEV
+            model = self.model
+            optimizer = self.optimizer
+            scheduler = self.scheduler
+            scaler = self.scaler
+            accum_steps = self.gradient_accumulation_steps
+            is_ddp = isinstance(model, DistributedDataParallel)
+            track_gpu_memory = self.track_gpu_memory
             try:
-                for sample_counter, batch in enumerate(self.train_dataloader):
+                for sample_counter, batch in enumerate(self.batches(self.train_dataloader)):
 
 
                     # Progress update every 50 batches.
-                    if sample_counter % 50 == 0 and not sample_counter == 0:
+                    # Only format the message if it will be logged:
+                    if sample_counter % 50 == 0 and not sample_counter == 0 \
+                        and self.log.is_enabled_for(logging.INFO):
                         # Calculate elapsed time in minutes.
                         elapsed = self.format_time(time.time() - t0)
-                        elapsed = self.log.info(f"Elapsed: {elapsed}") 
                         
                         # Report progress.
-                        self.log_info(f"  Epoch: {epoch_i} Batch {sample_counter} of {self.total_num_batches}")
+                        self.log.info(f"  Epoch: {epoch_i} Batch {sample_counter} of {num_batches}; elapsed: {elapsed}")
             
                     # Unpack this training batch from our dataloader. 
                     #
-                    # As we unpack the batch, we'll also copy each tensor to the GPU using the 
-                    # `to` method.
+                    # When using a GPU, batches() has already copied
+                    # each tensor to the GPU.
                     #
                     # `batch` contains three pytorch tensors:
                     #   [0]: input ids 
                     #   [1]: attention masks
                     #   [2]: labels
+                    #
+                    # Token ids arrive as int16, and labels as int8 
+                    # to save transfer bandwidth. They are widened to 
+                    # the int64 that the embedding lookup and the loss 
+                    # require only after the copy to the GPU.
 
-                    if self.testing_cuda_on_cpu:
-                        self.gpu_device = self.CPU_DEV
-
-                    if self.gpu_device == self.CPU_DEV:
-                        b_input_ids = batch['tok_ids']
-                        b_input_mask = batch['attention_mask']
-                        b_labels = batch['label']
-                    else:
-                        b_input_ids = batch['tok_ids'].to(device=self.cuda_dev)
-                        b_input_mask = batch['attention_mask'].to(device=self.cuda_dev)
-                        b_labels = batch['label'].to(device=self.cuda_dev)
+                    b_input_ids = batch['tok_ids'].long()
+                    b_input_mask = batch['attention_mask']
+                    b_labels = batch['label'].long()
             
+                    # With gradient accumulation, the optimizer only
+                    # steps after every gradient_accumulation_steps 
+                    # batches, and at the end of the epoch. Gradients 
+                    # of the batches in between add up:
+                    is_last_accum = (sample_counter + 1) % accum_steps == 0 or \
+                                    sample_counter + 1 == num_batches
+
                     # Always clear any previously calculated gradients before performing a
                     # backward pass. PyTorch doesn't do this automatically because 
                     # accumulating the gradients is "convenient while training RNNs". 
                     # (source: https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch)
-                    self.model.zero_grad()        
+                    # Here: only at the start of each accumulation.
+                    # Setting the gradients to None, rather than to 
+                    # zero, saves writing zeros into every one of them:
+                    if sample_counter % accum_steps == 0:
+                        optimizer.zero_grad(set_to_none=True)
             
                     # Note GPU usage:
-                    if self.gpu_device != self.CPU_DEV:
+                    if track_gpu_memory:
                         self.history_checkpoint(epoch_i, sample_counter,'pre_model_call')
-                        
-                    # Perform a forward pass (evaluate the model on this training batch).
-                    # The documentation for this `model` function is here: 
-                    # https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
-                    # It returns different numbers of parameters depending on what arguments
-                    # arge given and what flags are set. For our useage here, it returns
-                    # the train_loss (because we provided labels) and the "logits"--the model
-                    # outputs prior to activation.
-                    train_loss, logits = self.model(b_input_ids, 
-                                                    token_type_ids=None, 
-                                                    attention_mask=b_input_mask, 
-                                                    labels=b_labels)
                     
-                    if self.gpu_device != self.CPU_DEV:
-                        b_input_ids = b_input_ids.to('cpu')
-                        logits = logits.to('cpu')
-                        b_labels = b_labels.to('cpu')
-                        del b_input_mask
-                        cuda.empty_cache()                    
+                    # DDP would AllReduce the gradients in every
+                    # backward pass. Only the last pass before an
+                    # optimizer step needs that. No_sync() must cover
+                    # both, forward and backward pass:
+                    if is_last_accum or not is_ddp:
+                        sync_context = contextlib.nullcontext()
+                    else:
+                        sync_context = model.no_sync()
+                    
+                    with sync_context:
+                        # Perform a forward pass (evaluate the model on this training batch).
+                        # The documentation for this `model` function is here: 
+                        # https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
+                        # It returns different numbers of parameters depending on what arguments
+                        # arge given and what flags are set. For our useage here, it returns
+                        # the train_loss (because we provided labels) and the "logits"--the model
+                        # outputs prior to activation.
+                        with torch.autocast('cuda', enabled=self.use_amp, dtype=self.amp_dtype):
+                            train_loss, logits = model(b_input_ids, 
+                                                            token_type_ids=None, 
+                                                            attention_mask=b_input_mask, 
+                                                            labels=b_labels)
+                    
+                        if on_gpu:
+                            del b_input_mask
     
-                    train_acc = self.accuracy(logits, b_labels)
-                    total_train_accuracy += train_acc
+                        # Accuracy is computed where the logits live.
+                        # Moving logits and labels to the CPU for each
+                        # batch would stall the GPU pipeline:
+                        total_train_accuracy += self.accuracy_on_device(logits, b_labels)
     
-                    # Note GPU usage:
-                    if self.gpu_device != self.CPU_DEV:
-                        self.history_checkpoint(epoch_i, sample_counter,'post_model_call')
+                        # Note GPU usage:
+                        if track_gpu_memory:
+                            self.history_checkpoint(epoch_i, sample_counter,'post_model_call')
     
-                    # Accumulate the training train_loss over all of the batches so that we can
-                    # calculate the average train_loss at the end. `train_loss` is a Tensor containing a
-                    # single value; the `.item()` function just returns the Python value 
-                    # from the tensor.
-                    total_train_loss += train_loss.item()
+                        # Accumulate the training train_loss over all of the batches so that we can
+                        # calculate the average train_loss at the end. `train_loss` is a Tensor containing a
+                        # single value. It stays on the device until the end 
+                        # of the epoch, where a single .item() retrieves the total:
+                        total_train_loss += train_loss.detach()
             
-                    # Perform a backward pass to calculate the gradients.
-                    if self.gpu_device != self.CPU_DEV:
-                        # Third AMP related change:
-                        with amp.scale_loss(train_loss, self.optimizer) as scaled_loss:
-                            scaled_loss.backward()
-                    else:
-                        train_loss.backward()
+                        # Perform a backward pass to calculate the gradients.
+                        # The loss is averaged over the accumulated batches:
+                        scaler.scale(train_loss / accum_steps).backward()
 
-                    # Clip the norm of the gradients to 1.0.
-                    # This is to help prevent the "exploding gradients" problem.
-                    # From torch:
-                    nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
-            
-                    if self.gpu_device != self.CPU_DEV:
+                    if on_gpu:
                         del b_input_ids
                         del b_labels
                         del train_loss
                         del logits
-                        cuda.empty_cache()
+                    if track_gpu_memory:
                         self.history_checkpoint(epoch_i, sample_counter,'post_model_freeing')
      
     
+                    if not is_last_accum:
+                        continue
+
+                    # Clip the norm of the gradients to 1.0.
+                    # This is to help prevent the "exploding gradients" problem.
+                    # Gradients must be unscaled first, so the
+                    # threshold applies to their true values. On
+                    # GPUs, the norms of all gradients are computed
+                    # with a few multi-tensor kernels (foreach), 
+                    # rather than with several kernels per tensor:
+                    scaler.unscale_(optimizer)
+                    nn.utils.clip_grad_norm_(model.parameters(), 1.0,
+                                             foreach=True if on_gpu else None)
+
                     # Update parameters and take a sample_counter using the computed gradient.
                     # The self.optimizer dictates the "update rule"--how the parameters are
                     # modified based on their gradients, the learning rate, etc.
-                    
-                    self.optimizer.step()
-                    
+                    # The scaler skips the step if gradients overflowed:
+                
+                    scaler.step(optimizer)
+                    scaler.update()
+                
                     # Note GPU usage:
-                    if self.gpu_device != self.CPU_DEV:
-                        cuda.empty_cache()
+                    if track_gpu_memory:
                         self.history_checkpoint(epoch_i, sample_counter,'post_optimizer')
-                        
-                    # Update the learning rate.
-                    with warnings.catch_warnings(record=False):
-                        # Suppress the expected warning about 
-                        # lr_scheduler.step before optimizer.step()...
-                        warnings.filterwarnings('ignore',
-                                    message="Detected call of [`]lr_scheduler.step()[`]*",
-                                    category=UserWarning)
-
-                        self.scheduler.step()
+                    
+                    # Update the learning rate. The expected warning
+                    # about lr_scheduler.step() before optimizer.step()
+                    # is filtered in the constructor:
+                    scheduler.step()
 
                 # Calculate the average loss over all of the batches.
-                avg_train_loss = total_train_loss / len(self.train_dataloader)
-                avg_train_accuracy = total_train_accuracy / len(self.train_dataloader)
+                # Totals are tensors, unless the epoch had no batches: 
+                avg_train_loss = float(total_train_loss) / num_batches
+                avg_train_accuracy = float(total_train_accuracy) / num_batches
 
             except Exception as e:
                 msg = f"During train: {repr(e)}\n"
                     
-                if self.gpu_device != self.CPU_DEV and self.gpu_obj is not None:
-                    self.log.err(f"GPU memory used at crash time: {self.gpu_obj.memoryUsed}")
+                if self.gpu_device != self.CPU_DEV and not self.testing_cuda_on_cpu:
+                    self.log.err(f"GPU memory used at crash time: {self.gpu_memory()[1]}MB")
                     msg += "GPU use history:\n"
-                    for chckpt_dict in self.gpu_status_history:
-                        for event_info in chckpt_dict.keys():
-                            msg += f"    {event_info}:      {chckpt_dict[event_info]}\n"
+                    msg += self.format_gpu_history()
     
                 raise TrainError(msg).with_traceback(e.__traceback__)
                     
@@ -879,28 +1150,21 @@ class BertTrainer(object):
             total_val_loss = 0
             #nb_eval_steps = 0
         
-            # Start feeding validation set from the beginning:
-            self.val_dataloader.reset()
             # Evaluate data for one epoch
-            for batch in self.val_dataloader:
+            for batch in self.batches(self.val_dataloader):
                 
                 # Unpack this training batch from our dataloader. 
                 #
-                # As we unpack the batch, we'll also copy each tensor to the GPU using 
-                # the `to` method.
+                # When using a GPU, batches() has already copied
+                # each tensor to the GPU.
                 #
                 # `batch` contains three pytorch tensors:
                 #   [0]: input ids 
                 #   [1]: attention masks
                 #   [2]: labels
-                if self.gpu_device == self.CPU_DEV:
-                    b_input_ids = batch['tok_ids']
-                    b_input_mask = batch['attention_mask']
-                    b_labels = batch['label']
-                else:
-                    b_input_ids = batch['tok_ids'].to(device=self.cuda_dev)
-                    b_input_mask = batch['attention_mask'].to(device=self.cuda_dev)
-                    b_labels = batch['label'].to(device=self.cuda_dev)
+                b_input_ids = batch['tok_ids'].long()
+                b_input_mask = batch['attention_mask']
+                b_labels = batch['label'].long()
                 
                 # Tell pytorch not to bother with constructing the compute graph during
                 # the forward pass, since this is only needed for backprop (training).
@@ -913,22 +1177,15 @@ class BertTrainer(object):
                     # https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
                     # Get the "logits" output by the model. The "logits" are the output
                     # values prior to applying an activation function like the softmax.
-                    (val_loss, logits) = self.model(b_input_ids, 
-                                                    token_type_ids=None, 
-                                                    attention_mask=b_input_mask,
-                                                    labels=b_labels)
-                # Accumulate the validation loss and accuracy
-                    total_val_loss += val_loss.item()
-
-                if self.gpu_device != self.CPU_DEV:
-                    logits = logits.to('cpu')
-                    val_loss = val_loss.to('cpu')
-                    b_labels = b_labels.to('cpu')
-                try:
-                    total_val_accuracy += self.accuracy(logits, b_labels)
-                except TrainError as e:
-                    self.log.err(f"In epoch {epoch_i} (when total_val_loss is {total_val_loss}: {repr(e)}")
-                    raise TrainError from e
+                    with torch.autocast('cuda', enabled=self.use_amp, dtype=self.amp_dtype):
+                        (val_loss, logits) = self.model(b_input_ids, 
+                                                        token_type_ids=None, 
+                                                        attention_mask=b_input_mask,
+                                                        labels=b_labels)
+                # Accumulate the validation loss and accuracy.
+                # Both stay on the device until the end of the pass:
+                    total_val_loss += val_loss
+                    total_val_accuracy += self.accuracy_on_device(logits, b_labels)
 
                 if self.gpu_device != self.CPU_DEV:
                     del b_input_ids
@@ -936,11 +1193,10 @@ class BertTrainer(object):
                     del b_labels
                     del val_loss
                     del logits
-                    cuda.empty_cache()
 
             # Calculate the average loss over all of the batches.
-            avg_val_loss = total_val_loss / len(self.val_dataloader)
-            avg_val_accuracy = total_val_accuracy / len(self.val_dataloader)
+            avg_val_loss = float(total_val_loss) / len(self.val_dataloader)
+            avg_val_accuracy = float(total_val_accuracy) / len(self.val_dataloader)
             
             # Measure how long the validation run took.
             validation_time = self.format_time(time.time() - t0)
@@ -952,12 +1208,10 @@ class BertTrainer(object):
         except Exception as e:
             msg = f"During validate: {repr(e)}\n"
 
-            if self.gpu_device != self.CPU_DEV  and self.gpu_obj is not None:
-                self.log.err(f"GPU memory used at crash time: {self.gpu_obj.memoryUsed}")
+            if self.gpu_device != self.CPU_DEV  and not self.testing_cuda_on_cpu:
+                self.log.err(f"GPU memory used at crash time: {self.gpu_memory()[1]}MB")
                 msg += "GPU use history:\n"
-                for chckpt_dict in self.gpu_status_history:
-                    for event_info in chckpt_dict.keys():
-                        msg += f"    {event_info}:      {chckpt_dict[event_info]}\n"
+                msg += self.format_gpu_history()
 
             raise TrainError(msg).with_traceback(e.__traceback__)
             
@@ -992,20 +1246,15 @@ class BertTrainer(object):
         # Batches come as dicts with keys
         # sample_id, tok_ids, label, attention_mask: 
 
-        for batch in self.test_dataloader:
+        for batch in self.batches(self.test_dataloader):
              
-            if self.gpu_device == self.CPU_DEV:
-                b_input_ids = batch['tok_ids']
-                b_input_mask = batch['attention_mask']
-                b_labels = batch['label']
-            else:
-                b_input_ids = batch['tok_ids'].to(device=self.cuda_dev)
-                b_input_mask = batch['attention_mask'].to(device=self.cuda_dev)
-                b_labels = batch['label'].to(device=self.cuda_dev)
+            b_input_ids = batch['tok_ids'].long()
+            b_input_mask = batch['attention_mask']
+            b_labels = batch['label'].long()
             
             # Telling the model not to compute or store gradients, saving memory and 
             # speeding up prediction
-            with torch.no_grad():
+            with torch.no_grad(), torch.autocast('cuda', enabled=self.use_amp, dtype=self.amp_dtype):
                 (loss, logits) = self.model(b_input_ids, 
                                             token_type_ids=None, 
                                             attention_mask=b_input_mask,
@@ -1014,21 +1263,15 @@ class BertTrainer(object):
             if self.testing_cuda_on_cpu:
                 self.gpu_device = self.CPU_DEV
                     
-            # Move logits and labels to CPU, if the
-            # are not already:
-            if self.gpu_device != self.CPU_DEV:
-                logits = logits.to('cpu')
-                b_labels = b_labels.to('cpu')
-                loss = loss.to('cpu')
-                cuda.empty_cache()
-
             # Get the class prediction from the 
-            # logits:
-            predictions = self.logits_to_classes(logits)            
-            # Store all_predictions and true labels
-            all_predictions.extend(predictions)
-            labels = b_labels.numpy()
-            all_labels.extend(labels)
+            # logits. Predictions and true labels
+            # stay on the device, and are moved to 
+            # the CPU once, after the last batch:
+            all_predictions.append(logits.argmax(dim=-1))
+            all_labels.append(b_labels)
+        
+        all_predictions = torch.cat(all_predictions).cpu().numpy()
+        all_labels = torch.cat(all_labels).cpu().numpy()
         
         self.log.info('    DONE applying model to test set.')
         # Ordered list of label ints:
@@ -1049,7 +1292,6 @@ class BertTrainer(object):
 
         if self.gpu_device != self.CPU_DEV:
             del loss
-            cuda.empty_cache()
 
         return(all_predictions, all_labels)
 
@@ -1058,13 +1300,7 @@ class BertTrainer(object):
     #-------------------
 
     def evaluate(self, predictions, labels):
-        with warnings.catch_warnings(record=False):
-            # Suppress the expected warning about the
-            # double scalars:
-            warnings.filterwarnings('ignore',
-                                    message='invalid value encountered in double_scalars',
-                                    category=RuntimeWarning)
-            mcc = self.matthews_corrcoef(predictions, labels)
+        mcc = self.matthews_corrcoef(predictions, labels)
         self.log.info(f"Matthews correlation coefficient: {mcc}")
 
         test_accuracy = self.accuracy(predictions, labels)
@@ -1081,11 +1317,13 @@ class BertTrainer(object):
         predictions_path = f"{self.csv_file_root}_testset_predictions.csv"
         self.log.info(f"Saving predictions to {predictions_path}")
 
-        with open(predictions_path, 'w') as fd:
-            writer = csv.writer(fd)
-            writer.writerow(['prediction', 'true_label'])
-            for pred_truth_tuple in zip(predictions, labels):
-                writer.writerow(pred_truth_tuple)
+        # One column each, written in a single pass:
+        np.savetxt(predictions_path,
+                   np.column_stack((predictions, labels)),
+                   fmt='%d',
+                   delimiter=',',
+                   header='prediction,true_label',
+                   comments='')
         
         # Save the training stats:
         training_stats_path = f"{self.csv_file_root}_train_test_stats.json"
@@ -1114,7 +1352,11 @@ class BertTrainer(object):
         where the former are the log odds of each
         class. The latter are the classes decided by
         the highes-logit class. See self.logits_to_classes()
-            
+        
+        Uses the multiclass form of the coefficient, computed
+        from the confusion counts (see class_counts()). Like 
+        sklearn, returns 0.0 if the coefficient is undefined,
+        such as when all predictions are the same class.
         
         @param predicted_classes: array of predicted class labels
         @type predicted_classes: {[int]|[[float]]}
@@ -1123,12 +1365,52 @@ class BertTrainer(object):
         @return: Matthew's correlation coefficient,
         @rtype: float
         '''
-        if type(predicted_classes) == torch.Tensor and \
-            len(predicted_classes.shape) > 1:
-            predicted_classes = self.logits_to_classes(predicted_classes)
-        mcc = matthews_corrcoef(labels, predicted_classes)
-        return mcc
+        counts = self.class_counts(predicted_classes, labels).double()
+        num_true = counts.sum(dim=1)
+        num_predicted = counts.sum(dim=0)
+        num_correct = counts.trace()
+        num_samples = counts.sum()
+        
+        covariance = num_correct * num_samples - num_true @ num_predicted
+        denominator = torch.sqrt((num_samples**2 - num_predicted @ num_predicted) * 
+                                 (num_samples**2 - num_true @ num_true))
+        if denominator == 0:
+            return 0.0
+        return (covariance / denominator).item()
         
+    #------------------------------------
+    # class_counts 
+    #-------------------
+    
+    def class_counts(self, predicted_classes, labels):
+        '''
+        Return the confusion counts of predictions and 
+        true labels: element [i,j] is the number of samples 
+        of class i that were predicted to be class j. Counting
+        is a single bincount over true*K + predicted, on 
+        whatever device the predictions are. K is the 
+        number of label encodings, or larger if the data 
+        contain larger class numbers.
+        
+        @param predicted_classes: logits, or predicted classes
+        @type predicted_classes: {[int]|np.ndarray|torch.Tensor}
+        @param labels: true class of each sample
+        @type labels: {[int]|np.ndarray|torch.Tensor}
+        @return: K x K matrix of counts
+        @rtype: torch.Tensor
+        '''
+        predicted_classes = torch.as_tensor(predicted_classes)
+        labels = torch.as_tensor(labels, device=predicted_classes.device).long()
+        if predicted_classes.dim() > 1:
+            predicted_classes = predicted_classes.detach().argmax(dim=-1)
+        predicted_classes = predicted_classes.long()
+        
+        num_classes = len(self.label_encodings)
+        if len(labels) > 0:
+            num_classes = max(num_classes, 
+                              int(max(predicted_classes.max(), labels.max())) + 1)
+        return torch.bincount(labels * num_classes + predicted_classes,
+                              minlength=num_classes**2).view(num_classes, num_classes)
         
     #------------------------------------
     # confusion_matrix 
@@ -1152,6 +1434,7 @@ class BertTrainer(object):
 
         if matrix_labels is None:
             matrix_labels = self.label_encodings.values()
+        matrix_labels = list(matrix_labels)
             
         if type(logits_or_classes) == torch.Tensor and \
             len(logits_or_classes.shape) > 1:
@@ -1159,14 +1442,16 @@ class BertTrainer(object):
         else:
             predicted_classes = logits_or_classes
          
-        n_by_n_conf_matrix = confusion_matrix(y_true, 
-                                              predicted_classes, 
-                                              labels=matrix_labels
-                                              ) 
+        # Only the text report still comes from sklearn:
+        from sklearn.metrics import classification_report 
+        
+        counts = self.class_counts(predicted_classes, y_true).cpu()
+        # Rows and columns in the order of matrix_labels:
+        n_by_n_conf_matrix = counts[matrix_labels][:, matrix_labels].numpy()
            
         self.log.info('Confusion Matrix :')
         self.log.info(n_by_n_conf_matrix) 
-        self.log.info(f'Accuracy Score :{accuracy_score(y_true, predicted_classes)}')
+        self.log.info(f'Accuracy Score :{(counts.trace() / counts.sum()).item()}')
         self.log.info('Report : ')
         self.log.info(classification_report(y_true, predicted_classes))
         
@@ -1231,25 +1516,55 @@ class BertTrainer(object):
         the highes-logit class. See self.logits_to_classes()
 
         Accuracy is returned as percentage of times the
-        prediction agreed with the labels.
+        prediction agreed with the labels. Like 
+        matthews_corrcoef(), returns 0.0 if there are 
+        no samples.
         
         @param predicted_classes: raw predictions: for each sample: logit for each class 
-        @type predicted_classes:
+        @type predicted_classes: {[int]|np.ndarray|torch.Tensor}
         @param labels: for each sample: true class
-        @type labels: [int]
+        @type labels: {[int]|np.ndarray|torch.Tensor}
+        @return: fraction of correct predictions
+        @rtype: float
         '''
-        # Convert logits to classe predictions if needed:
-        if type(predicted_classes) == torch.Tensor and \
-            len(predicted_classes.shape) > 1:
-            # This call will also move the result to CPU:
-            predicted_classes = self.logits_to_classes(predicted_classes)
-        if type(labels) != np.ndarray:
-            if type(labels) == list:
-                labels = np.array(labels)
-            else:
-                labels = labels.numpy()            
-        # Compute number of times prediction was equal to the label.
-        return np.count_nonzero(predicted_classes == labels) / len(labels)
+        # Lists, arrays, and tensors all go through the
+        # same torch path:
+        predicted_classes = torch.as_tensor(predicted_classes)
+        labels = torch.as_tensor(labels, device=predicted_classes.device)
+        # Convert logits to class predictions if needed:
+        if predicted_classes.dim() > 1:
+            predicted_classes = predicted_classes.detach().argmax(dim=-1)
+        if labels.numel() == 0:
+            return 0.0
+        # Fraction of times prediction was equal to the label.
+        # Dividing Python ints keeps float32 rounding out of 
+        # the reported stats:
+        return int((predicted_classes == labels).sum()) / labels.numel()
+
+    #------------------------------------
+    # accuracy_on_device 
+    #-------------------
+
+    def accuracy_on_device(self, logits, labels):
+        '''
+        Like accuracy(), but for a batch of logits and
+        labels that are tensors on the same device. The
+        result stays on that device as well, so callers
+        can accumulate it without waiting for the GPU. 
+        It is a float64, so that sums over many batches
+        do not pick up float32 rounding. 
+        Retrieve the final value with float() or .item().
+        
+        @param logits: for each sample: logit for each class
+        @type logits: torch.Tensor
+        @param labels: for each sample: true class
+        @type labels: torch.Tensor
+        @return: fraction of samples whose highest logit
+            is that of the true class
+        @rtype: torch.Tensor (0-dimensional)
+        '''
+        predicted_classes = logits.detach().argmax(dim=-1)
+        return (predicted_classes == labels).double().mean()
 
     #------------------------------------
     # logits_to_classes 
@@ -1273,15 +1588,14 @@ class BertTrainer(object):
         @param logits: array of class logits
         @type logits: [[float]] or tensor([[float]])
         '''
-        # Run amax on every sample's logits array,
+        # Run argmax on every sample's logits array,
         # generating a class in place of each array.
         # The detach() is needed to get
         # just the tensors, without the gradient function
-        # from the tensor+grad. The [0] is needed, b/c
-        # the np.nonzero() returns a tuple whose only
-        # element is a one-valued array.
-        # There *must* be a more elegant way to do this!
-        pred_classes = np.argmax(logits.detach().numpy(), 1) 
+        # from the tensor+grad. The argmax runs wherever
+        # the logits are; only the classes are moved to
+        # the CPU, for the sklearn metrics:
+        pred_classes = logits.detach().argmax(dim=-1).cpu().numpy()
         return pred_classes
 
     #------------------------------------
@@ -1305,19 +1619,39 @@ class BertTrainer(object):
     #-------------------
 
     def history_checkpoint(self, epoch_num, sample_counter, process_moment):
-        #**********
-        return
-        #**********
+        '''
+        Record GPU memory use. Callers only invoke 
+        this method if self.track_gpu_memory is True.
+        '''
         # Note GPU usage:
+        (free_mem, used_mem) = self.gpu_memory()
         self.gpu_status_history.append(
             {'epoch_num'      : epoch_num,
              'sample_counter' : sample_counter,
              'process_moment' : process_moment,
-             'GPU_free_memory': self.gpu_obj.memoryFree,
-             'GPU_memory_used': self.gpu_obj.memoryUsed
+             'GPU_free_memory': free_mem,
+             'GPU_memory_used': used_mem
              }
             )
 
+    #------------------------------------
+    # format_gpu_history 
+    #-------------------
+
+    def format_gpu_history(self):
+        '''
+        Return the GPU memory history collected by 
+        history_checkpoint() as one line per entry 
+        of each checkpoint, for error messages.
+        
+        @return: the formatted history; empty if
+            no checkpoints were recorded
+        @rtype: str
+        '''
+        return ''.join(f"    {event_info}:      {value}\n"
+                       for chckpt_dict in self.gpu_status_history
+                       for (event_info, value) in chckpt_dict.items())
+
 # -------------------- Main ----------------
 if __name__ == '__main__':
 
@@ -1356,6 +1690,51 @@ if __name__ == '__main__':
                         default=False
                         )
 
+    parser.add_argument('-a', '--accumulate',
+                        type=int,
+                        help="number of batches whose gradients are accumulated per optimizer step (default: 1)",
+                        default=1
+                        )
+
+    parser.add_argument('-c', '--checkpoint_grads',
+                        action='store_true',
+                        help="recompute activations in backward pass to save GPU memory",
+                        default=False
+                        )
+
+    parser.add_argument('--compile',
+                        action='store_true',
+                        help="compile the model with torch.compile",
+                        default=False
+                        )
+
+    parser.add_argument('--cuda_graphs',
+                        action='store_true',
+                        help=("compile the model, and replay its steps as CUDA graphs (implies --compile); "
+                              "batches are bucketed by length and padded to multiples of "
+                              f"{BertTrainer.CUDA_GRAPH_WIDTH_MULTIPLE} tokens, "
+                              "and each distinct batch shape keeps its own graph and GPU memory pool"),
+                        default=False
+                        )
+
+    parser.add_argument('--bf16',
+                        action='store_true',
+                        help="use bfloat16 rather than float16 mixed precision (Ampere GPUs or newer)",
+                        default=False
+                        )
+
+    parser.add_argument('--rebuild_cache',
+                        action='store_true',
+                        help="re-read the data splits from the db, rather than from the split cache",
+                        default=False
+                        )
+
+    parser.add_argument('--no_gpu_resident',
+                        action='store_true',
+                        help="never keep the dataset in GPU memory; always batch through loader workers",
+                        default=False
+                        )
+
     parser.add_argument('data_source_path',
                         help='path to csv or sqlite file to process')
 
@@ -1369,7 +1748,13 @@ if __name__ == '__main__':
                      logfile=args.logfile,
                      preponly=args.preponly,
                      started_from_launch=args.started_from_launch,
-                     testing_cuda_on_cpu=False
+                     testing_cuda_on_cpu=False,
+                     gradient_accumulation_steps=args.accumulate,
+                     gradient_checkpointing=args.checkpoint_grads,
+                     compile_model='reduce-overhead' if args.cuda_graphs else args.compile,
+                     bf16=args.bf16,
+                     rebuild_cache=args.rebuild_cache,
+                     gpu_resident=not args.no_gpu_resident
                      )
          
     
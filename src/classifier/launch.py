@@ -402,6 +402,9 @@ def main():
     # the master node, whose numbers are 0,1,...<ngpus_here>:
 
     current_env['NODE_RANK'] = str(args.node_rank)
+    # Number of processes on this node, as torchrun 
+    # sets it. Dataloaders divide the node's CPUs by it:
+    current_env['LOCAL_WORLD_SIZE'] = str(world_layout['localhost'])
 
     for local_rank in range(0, world_layout['localhost']):
 
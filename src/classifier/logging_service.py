@@ -196,6 +196,23 @@ class LoggingService(metaclass=MetaLoggingSingleton):
         LoggingService.logger.addHandler(handler)
         LoggingService.logger.setLevel(loggingLevel)
 
+    #-------------------------
+    # is_enabled_for 
+    #--------------
+
+    def is_enabled_for(self, level):
+        '''
+        Return True if messages of the given level
+        would be logged. Lets callers skip building
+        messages that would be discarded.
+        
+        @param level: logging level to check
+        @type level: {logging.INFO|WARN|ERROR|DEBUG}
+        @return: whether the level is currently logged
+        @rtype: bool
+        '''
+        return LoggingService.logger.isEnabledFor(level)
+
     #-------------------------
     # log_debug/warn/info/err 
     #--------------
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''
+Created on Oct 15, 2026
+
+@author: paepcke
+'''
+from collections import deque
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from bert_feeder_dataset import FrozenDataset
+from logging_service import LoggingService
+
+
+class FrozenBatchTester(unittest.TestCase):
+
+    # Number of samples we'll put into the test db:
+    num_samples = 12
+
+    # Tokens per sample, including padding:
+    sequence_len = 6
+
+    #------------------------------------
+    # setUp
+    #-------------------
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.log = LoggingService()
+        self.tmp_dir = tempfile.mkdtemp(prefix='FrozenBatches', dir='/tmp')
+        self.db_path = os.path.join(self.tmp_dir, 'test_db.sqlite')
+
+        db = sqlite3.connect(self.db_path)
+        db.execute('''CREATE TABLE Samples (sample_id int primary key,
+                                            tok_ids text,
+                                            attention_mask text,
+                                            label int
+                                            )
+                   ''')
+        # Sample i has i % sequence_len + 1 non-padding tokens:
+        rows = []
+        for sample_id in range(self.num_samples):
+            num_toks = sample_id % self.sequence_len + 1
+            padding = [0] * (self.sequence_len - num_toks)
+            rows.append((sample_id,
+                         str([sample_id + 100] * num_toks + padding),
+                         str([1] * num_toks + padding),
+                         sample_id % 2
+                         ))
+        db.executemany('INSERT INTO Samples VALUES(?,?,?,?)', rows)
+        db.commit()
+        db.close()
+
+        # Non-padding tokens: 2, 4, 6, 2, 3, 4
+        self.dataset = FrozenDataset(self.log,
+                                     self.db_path,
+                                     'train',
+                                     deque([7, 3, 5, 1, 2, 9]),
+                                     {0 : 0, 1 : 1},
+                                     list(range(self.num_samples))
+                                     )
+
+    #------------------------------------
+    # tearDown
+    #-------------------
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    #------------------------------------
+    # testTrimmedWidths
+    #-------------------
+
+    def testTrimmedWidths(self):
+        self.assertEqual(self.batch_width([0, 3]), 2)
+        self.assertEqual(self.batch_width([0, 4]), 3)
+        self.assertEqual(self.batch_width([0, 1, 3]), 4)
+        self.assertEqual(self.batch_width([3, 2]), self.sequence_len)
+        self.assertEqual(self.batch_width(range(6)), self.sequence_len)
+
+        batch = self.dataset.__getitems__([0, 4])
+        self.assertEqual(batch['sample_id'].tolist(), [7, 2])
+        self.assertEqual(batch['label'].tolist(), [1, 0])
+        # Only padding was cut off:
+        self.assertEqual(batch['tok_ids'].tolist(), [[107, 107, 0],
+                                                     [102, 102, 102]])
+        self.assertEqual(batch['attention_mask'].tolist(), [[1, 1, 0],
+                                                            [1, 1, 1]])
+
+    #------------------------------------
+    # testRoundedWidths
+    #-------------------
+
+    def testRoundedWidths(self):
+        self.dataset.width_multiple = 4
+        self.assertEqual(self.batch_width([0, 3]), 4)
+        self.assertEqual(self.batch_width([0, 4]), 4)
+        self.assertEqual(self.batch_width([1, 5]), 4)
+        # Never wider than the stored sequences:
+        self.assertEqual(self.batch_width([0, 2]), self.sequence_len)
+
+        batch = self.dataset.__getitems__([0, 3])
+        self.assertEqual(batch['tok_ids'].tolist(), [[107, 107, 0, 0],
+                                                     [101, 101, 0, 0]])
+
+        self.dataset.width_multiple = 3
+        self.assertEqual(self.batch_width([0, 3]), 3)
+        self.assertEqual(self.batch_width([1]), 6)
+
+    #------------------------------------
+    # batch_width
+    #-------------------
+
+    def batch_width(self, indices):
+        batch = self.dataset.__getitems__(list(indices))
+        self.assertEqual(batch['tok_ids'].shape, batch['attention_mask'].shape)
+        return batch['tok_ids'].shape[1]
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+Created on Oct 15, 2026
+
+@author: paepcke
+'''
+from collections import OrderedDict
+import math
+import unittest
+
+import torch
+
+from bert_train_parallel import BertTrainer
+
+
+class MetricsTester(unittest.TestCase):
+
+    #------------------------------------
+    # setUp
+    #-------------------
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        # The constructor loads a dataset and sets up
+        # GPUs; the metrics only need the label encodings:
+        self.trainer = object.__new__(BertTrainer)
+        self.trainer.label_encodings = OrderedDict({'right'   : 0,
+                                                    'left'    : 1,
+                                                    'neutral' : 2})
+
+        self.labels      = [0, 0, 1, 1, 2, 2, 2]
+        self.predictions = [0, 1, 1, 1, 2, 0, 2]
+
+        # Rows: true class, columns: predicted class:
+        self.confusion = [[1, 1, 0],
+                          [0, 2, 0],
+                          [1, 0, 2]]
+
+    #------------------------------------
+    # testClassCounts
+    #-------------------
+
+    def testClassCounts(self):
+        counts = self.trainer.class_counts(self.predictions, self.labels)
+        self.assertEqual(counts.tolist(), self.confusion)
+
+        # Logits give the same counts as their argmax:
+        logits = torch.nn.functional.one_hot(torch.tensor(self.predictions), 3).float()
+        counts = self.trainer.class_counts(logits, self.labels)
+        self.assertEqual(counts.tolist(), self.confusion)
+
+        # Classes absent from the data still get rows and columns:
+        counts = self.trainer.class_counts([1, 1], [1, 0])
+        self.assertEqual(counts.tolist(), [[0, 1, 0],
+                                           [0, 1, 0],
+                                           [0, 0, 0]])
+
+    #------------------------------------
+    # testMatthewsCorrcoef
+    #-------------------
+
+    def testMatthewsCorrcoef(self):
+        # From the confusion matrix above: 5 correct of 7,
+        # 2,2,3 true and 2,3,2 predicted samples per class:
+        #    (5*7 - (2*2 + 2*3 + 3*2)) /
+        #       sqrt((7**2 - (2**2 + 3**2 + 2**2)) * (7**2 - (2**2 + 2**2 + 3**2)))
+        #    = 19 / 32
+        self.assertAlmostEqual(self.trainer.matthews_corrcoef(self.predictions, self.labels),
+                               19 / 32)
+
+        # Binary: TP=1, FN=1, TN=2, FP=0:
+        self.assertAlmostEqual(self.trainer.matthews_corrcoef([1, 0, 0, 0], [1, 1, 0, 0]),
+                               (1 * 2 - 0 * 1) / math.sqrt(1 * 2 * 2 * 3))
+
+        self.assertAlmostEqual(self.trainer.matthews_corrcoef(self.labels, self.labels), 1.0)
+
+    #------------------------------------
+    # testMatthewsCorrcoefUndefined
+    #-------------------
+
+    def testMatthewsCorrcoefUndefined(self):
+        # All predictions the same class:
+        self.assertEqual(self.trainer.matthews_corrcoef([1, 1, 1, 1], [0, 1, 2, 1]), 0.0)
+        # Only one class in the data:
+        self.assertEqual(self.trainer.matthews_corrcoef([2, 2, 2], [2, 2, 2]), 0.0)
+        # No samples:
+        self.assertEqual(self.trainer.matthews_corrcoef([], []), 0.0)
+
+    #------------------------------------
+    # testAccuracy
+    #-------------------
+
+    def testAccuracy(self):
+        self.assertEqual(self.trainer.accuracy(self.predictions, self.labels), 5 / 7)
+        # Not rounded to float32:
+        self.assertEqual(self.trainer.accuracy([1] * 13 + [0] * 12, [1] * 25), 0.52)
+        self.assertEqual(self.trainer.accuracy([], []), 0.0)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+'''
+Created on Oct 15, 2026
+
+@author: paepcke
+'''
+import unittest
+
+from torch.utils.data.distributed import DistributedSampler
+
+from bert_feeder_dataloader import BucketBatchSampler, NodeLocalDistributedSampler
+import numpy as np
+
+
+class SamplerTester(unittest.TestCase):
+
+    # Number of samples in the test dataset:
+    num_samples = 203
+
+    #------------------------------------
+    # setUp
+    #-------------------
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        # The samplers only need len() of the dataset:
+        self.dataset = list(range(self.num_samples))
+        rng = np.random.default_rng(1)
+        self.lengths = rng.integers(1, 128, self.num_samples)
+
+    #------------------------------------
+    # testBucketBatchesPerRank
+    #-------------------
+
+    def testBucketBatchesPerRank(self):
+        for world_size in (1, 2, 3):
+            for batch_size in (1, 4, 32):
+                for drop_last in (False, True):
+                    samplers = [self.bucket_sampler(world_size, rank, batch_size, drop_last)
+                                for rank in range(world_size)]
+                    # Every rank makes the same number of steps:
+                    self.assertEqual(len({len(sampler) for sampler in samplers}), 1)
+                    all_indices = []
+                    for sampler in samplers:
+                        batches = list(sampler)
+                        self.assertEqual(len(batches), len(sampler))
+                        sizes = [len(batch) for batch in batches]
+                        if drop_last:
+                            self.assertTrue(all(size == batch_size for size in sizes))
+                        else:
+                            # At most one short batch:
+                            self.assertLessEqual(sum(size != batch_size for size in sizes), 1)
+                            self.assertEqual(sum(sizes), len(sampler.sampler))
+                        all_indices.extend(index for batch in batches for index in batch)
+                    if drop_last:
+                        # No sample is drawn twice:
+                        self.assertEqual(len(set(all_indices)), len(all_indices))
+                    else:
+                        # Every sample is drawn:
+                        self.assertEqual(set(all_indices), set(self.dataset))
+
+    #------------------------------------
+    # testBucketsGroupSimilarLengths
+    #-------------------
+
+    def testBucketsGroupSimilarLengths(self):
+        sampler = self.bucket_sampler(1, 0, 8, True)
+        batches = list(sampler)
+        spread = np.mean([np.ptp(self.lengths[batch]) for batch in batches])
+        # Randomly drawn batches spread over most of
+        # the 1..127 range; bucketed ones do not:
+        self.assertLess(spread, 20)
+
+    #------------------------------------
+    # testBucketEpochs
+    #-------------------
+
+    def testBucketEpochs(self):
+        sampler = self.bucket_sampler(2, 0, 4, True)
+        sampler.set_epoch(0)
+        epoch0 = list(sampler)
+        sampler.set_epoch(1)
+        epoch1 = list(sampler)
+        self.assertNotEqual(epoch0, epoch1)
+        # Same epoch, same batches:
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), epoch0)
+
+    #------------------------------------
+    # testNodeLocalCoverage
+    #-------------------
+
+    def testNodeLocalCoverage(self):
+        for (num_nodes, procs_per_node) in ((2, 1), (2, 3), (3, 2)):
+            for drop_last in (False, True):
+                samplers = self.node_local_samplers(num_nodes, procs_per_node, drop_last)
+                self.assertEqual(len({len(sampler) for sampler in samplers}), 1)
+                all_indices = []
+                for sampler in samplers:
+                    indices = list(sampler)
+                    self.assertEqual(len(indices), len(sampler))
+                    all_indices.extend(indices)
+                if drop_last:
+                    self.assertEqual(len(set(all_indices)), len(all_indices))
+                else:
+                    self.assertEqual(set(all_indices), set(self.dataset))
+
+    #------------------------------------
+    # testNodeLocalEpochs
+    #-------------------
+
+    def testNodeLocalEpochs(self):
+        (num_nodes, procs_per_node) = (2, 2)
+        samplers = self.node_local_samplers(num_nodes, procs_per_node, True)
+        node_partitions = [set(samplers[node_rank * procs_per_node].node_indices)
+                           for node_rank in range(num_nodes)]
+        self.assertFalse(node_partitions[0] & node_partitions[1])
+
+        node_samples = {}
+        for epoch in (0, 1):
+            for sampler in samplers:
+                sampler.set_epoch(epoch)
+            for node_rank in range(num_nodes):
+                node_samplers = samplers[node_rank * procs_per_node : (node_rank + 1) * procs_per_node]
+                node_samples[(epoch, node_rank)] = [list(sampler) for sampler in node_samplers]
+
+        for node_rank in range(num_nodes):
+            epoch0 = node_samples[(0, node_rank)]
+            epoch1 = node_samples[(1, node_rank)]
+            # Reshuffled within the node...
+            self.assertNotEqual(epoch0, epoch1)
+            # ...but never drawn from another node's samples:
+            for indices in epoch0 + epoch1:
+                self.assertTrue(set(indices) <= node_partitions[node_rank])
+
+    #------------------------------------
+    # bucket_sampler
+    #-------------------
+
+    def bucket_sampler(self, world_size, rank, batch_size, drop_last):
+        sampler = DistributedSampler(self.dataset,
+                                     num_replicas=world_size,
+                                     rank=rank,
+                                     shuffle=True,
+                                     drop_last=drop_last)
+        return BucketBatchSampler(sampler,
+                                  batch_size,
+                                  self.lengths,
+                                  num_buckets=5,
+                                  shuffle=True,
+                                  drop_last=drop_last)
+
+    #------------------------------------
+    # node_local_samplers
+    #-------------------
+
+    def node_local_samplers(self, num_nodes, procs_per_node, drop_last):
+        '''
+        Return the samplers of all processes, ordered
+        by node, then by local rank.
+        '''
+        return [NodeLocalDistributedSampler(self.dataset,
+                                            num_nodes=num_nodes,
+                                            node_rank=node_rank,
+                                            procs_per_node=procs_per_node,
+                                            local_rank=local_rank,
+                                            shuffle=True,
+                                            drop_last=drop_last)
+                for node_rank in range(num_nodes)
+                for local_rank in range(procs_per_node)]
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
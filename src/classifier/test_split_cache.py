@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+Created on Oct 15, 2026
+
+@author: paepcke
+'''
+from collections import deque
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from bert_feeder_dataset import FrozenDataset
+from logging_service import LoggingService
+
+
+class SplitCacheTester(unittest.TestCase):
+
+    # Number of samples we'll put into the test db:
+    num_samples = 12
+
+    # Tokens per sample:
+    sequence_len = 6
+
+    #------------------------------------
+    # setUp
+    #-------------------
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.log = LoggingService()
+        self.tmp_dir = tempfile.mkdtemp(prefix='SplitCache', dir='/tmp')
+        self.db_path = os.path.join(self.tmp_dir, 'test_db.sqlite')
+        self.cache_dir = os.path.join(self.tmp_dir, 'split_cache')
+
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute('''CREATE TABLE Samples (sample_id int primary key,
+                                                 tok_ids text,
+                                                 attention_mask text,
+                                                 label int
+                                                 )
+                        ''')
+        rows = []
+        for sample_id in range(self.num_samples):
+            num_toks = sample_id % self.sequence_len + 1
+            padding = [0] * (self.sequence_len - num_toks)
+            rows.append((sample_id,
+                         str([sample_id + 100] * num_toks + padding),
+                         str([1] * num_toks + padding),
+                         sample_id % 2
+                         ))
+        self.db.executemany('INSERT INTO Samples VALUES(?,?,?,?)', rows)
+        self.db.commit()
+
+        self.queue = deque([7, 3, 5, 1, 2, 9])
+
+    #------------------------------------
+    # tearDown
+    #-------------------
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    #------------------------------------
+    # testSameContentSameEntry
+    #-------------------
+
+    def testSameContentSameEntry(self):
+        first = self.make_split()
+        second = self.make_split()
+        self.assertEqual(first.cache_path, second.cache_path)
+        self.assertIsInstance(second.tok_ids, np.memmap)
+        self.assertTrue((first.tok_ids == second.tok_ids).all())
+        self.assertEqual(second.sample_id_arr.tolist(), list(self.queue))
+
+    #------------------------------------
+    # testChangedSamplesNewEntry
+    #-------------------
+
+    def testChangedSamplesNewEntry(self):
+        first = self.make_split()
+
+        # Swap two labels; the sum of labels stays the same:
+        self.db.execute('UPDATE Samples SET label = 0 WHERE sample_id = 7')
+        self.db.execute('UPDATE Samples SET label = 1 WHERE sample_id = 2')
+        # Re-importing a CSV file recomputes the hash:
+        self.db.execute('DROP TABLE SamplesHash')
+        self.db.commit()
+
+        second = self.make_split()
+        self.assertNotEqual(first.cache_path, second.cache_path)
+        self.assertEqual(second[0]['label'].item(), 0)
+        self.assertEqual(second[4]['label'].item(), 1)
+
+    #------------------------------------
+    # testChangedTokensNewEntry
+    #-------------------
+
+    def testChangedTokensNewEntry(self):
+        first = self.make_split()
+
+        # Same string length as before:
+        self.db.execute(f'''UPDATE Samples
+                               SET tok_ids = '{str([200] + [0] * (self.sequence_len - 1))}'
+                             WHERE sample_id = 6''')
+        self.db.execute('DROP TABLE SamplesHash')
+        self.db.commit()
+
+        self.assertNotEqual(first.cache_path, self.make_split().cache_path)
+
+    #------------------------------------
+    # testChangedSplitNewEntry
+    #-------------------
+
+    def testChangedSplitNewEntry(self):
+        first = self.make_split()
+        self.queue.rotate(1)
+        self.assertNotEqual(first.cache_path, self.make_split().cache_path)
+
+    #------------------------------------
+    # testRebuild
+    #-------------------
+
+    def testRebuild(self):
+        first = self.make_split()
+        labels = first.labels.copy()
+
+        # Simulate an entry written by an older version
+        # of load_split():
+        stale_file = os.path.join(self.tmp_dir, 'labels.npy')
+        np.save(stale_file, np.full(len(labels), 5, dtype=np.int8))
+        os.replace(stale_file, os.path.join(first.cache_path, 'labels.npy'))
+        stale = self.make_split()
+        self.assertTrue((stale.labels == 5).all())
+
+        rebuilt = self.make_split(rebuild_cache=True)
+        self.assertEqual(rebuilt.cache_path, first.cache_path)
+        self.assertTrue((rebuilt.labels == labels).all())
+        self.assertTrue((self.make_split().labels == labels).all())
+
+        # Arrays mapped before the rebuild remain readable:
+        self.assertTrue((stale.labels == 5).all())
+        self.assertTrue((first.labels == labels).all())
+
+        # No temporary dirs are left behind:
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(first.cache_path)])
+
+    #------------------------------------
+    # make_split
+    #-------------------
+
+    def make_split(self, rebuild_cache=False):
+        return FrozenDataset(self.log,
+                             self.db_path,
+                             'train',
+                             self.queue.copy(),
+                             {0 : 0, 1 : 1},
+                             list(range(self.num_samples)),
+                             cache_dir=self.cache_dir,
+                             rebuild_cache=rebuild_cache
+                             )
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()